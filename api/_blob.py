@@ -0,0 +1,328 @@
+"""Minimal Vercel Blob helpers shared by the api/* handlers.
+
+Reads are cached in process memory: the resolved public URL, the ETag and
+the last body. Within READ_TTL the cached body is returned as is; after
+that the blob is revalidated with If-None-Match, so unchanged JSON costs a
+304 instead of a download.
+
+write_json(..., if_match=etag) only overwrites the version that was read
+and raises PreconditionFailed otherwise; update_json() wraps that into a
+read-modify-write loop for objects with more than one writer.
+
+STORAGE_BACKEND=local keeps the same JSON objects as files under
+STORAGE_DIR instead (atomic write + rename, mtime/size as the ETag), for
+the local server and offline runs. STORAGE_MMAP=1 reads them through mmap.
+"""
+import copy, json, mmap, os, random, tempfile, threading, time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import _net, _trace
+
+BLOB_TOKEN = os.environ.get("BLOB_READ_WRITE_TOKEN", "")
+BLOB_API = os.environ.get("BLOB_API_URL", "https://blob.vercel-storage.com")
+BLOB_PUBLIC_URL = os.environ.get("BLOB_PUBLIC_URL", "https://{store_id}.public.blob.vercel-storage.com")
+TIMEOUT = 10
+READ_TTL = float(os.environ.get("BLOB_READ_TTL", "5"))  # seconds
+
+BACKEND = os.environ.get("STORAGE_BACKEND", "vercel").strip().lower()  # vercel | local
+STORAGE_DIR = os.environ.get("STORAGE_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".storage")
+USE_MMAP = os.environ.get("STORAGE_MMAP", "") == "1"
+
+_MISSING = object()
+_cache = {}  # path -> {"url", "etag", "body", "checked"}
+_cache_lock = threading.Lock()
+_stats = {"hits": 0, "revalidated": 0, "misses": 0}
+_write_lock = threading.Lock()  # local backend: check + rename for if_match
+_update_locks = {}  # path -> lock: writers in this process queue instead of racing
+UPDATE_RETRIES = 8
+
+
+class PreconditionFailed(Exception):
+    """The object changed since it was read (if_match did not match)."""
+
+
+def configured():
+    """True if there is somewhere to read and write (Blob token or local backend)."""
+    return BACKEND == "local" or bool(BLOB_TOKEN)
+
+
+def get_store_id():
+    """Extract store ID from token: vercel_blob_rw_STOREID_..."""
+    parts = BLOB_TOKEN.split("_")
+    if len(parts) >= 4:
+        return parts[3]
+    return None
+
+
+def cache_stats():
+    """Hit/miss counters: hits (served from memory), revalidated (304), misses (downloaded)."""
+    return dict(_stats)
+
+
+def invalidate(path=None):
+    with _cache_lock:
+        if path is None:
+            _cache.clear()
+        else:
+            _cache.pop(path, None)
+
+
+def _count(key):
+    with _cache_lock:
+        _stats[key] += 1
+
+
+def _remember(path, url, etag, body):
+    entry = {"url": url, "etag": etag, "body": body, "checked": time.monotonic()}
+    with _cache_lock:
+        _cache[path] = entry
+    return entry
+
+
+def _result(body, default):
+    return default if body is _MISSING else copy.deepcopy(body)
+
+
+def _fetch(path, url, entry):
+    """GET url, revalidating the cached entry if there is one. Returns the new entry."""
+    headers = {}
+    if entry and entry.get("etag") and entry.get("url") == url:
+        headers["If-None-Match"] = entry["etag"]
+    resp = _net.request("GET", url, headers=headers, timeout=TIMEOUT)
+    if resp.status == 304 and entry:
+        _count("revalidated")
+        return _remember(path, url, entry["etag"], entry["body"])
+    _count("misses")
+    return _remember(path, url, resp.headers.get("ETag"), resp.json())
+
+
+def _resolve_url(path):
+    """Public URL of a blob, via the list API. None if it doesn't exist."""
+    data = _net.get_json(f"{BLOB_API}?prefix={path}",
+                         headers={"Authorization": f"Bearer {BLOB_TOKEN}"}, timeout=TIMEOUT)
+    for blob in data.get("blobs", []):
+        if blob.get("pathname", path) == path and blob.get("url"):
+            return blob["url"]
+    return None
+
+
+def _local_file(path):
+    full = os.path.normpath(os.path.join(STORAGE_DIR, path))
+    if not full.startswith(os.path.normpath(STORAGE_DIR) + os.sep):
+        raise ValueError(f"Invalid storage path: {path}")
+    return full
+
+
+def _local_read(path, entry):
+    """Local backend read; the stat signature plays the role of the ETag."""
+    full = _local_file(path)
+    try:
+        st = os.stat(full)
+    except FileNotFoundError:
+        _count("misses")
+        return _remember(path, None, None, _MISSING)
+    etag = _stat_etag(st)
+    if entry and entry.get("etag") == etag:
+        _count("revalidated")
+        return _remember(path, full, etag, entry["body"])
+    with open(full, "rb") as f:
+        if USE_MMAP and st.st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                body = json.loads(mm[:])
+        else:
+            body = json.loads(f.read())
+    _count("misses")
+    return _remember(path, full, etag, body)
+
+
+def _stat_etag(st):
+    # os.replace gives every write a new inode; mtime alone is too coarse for quick writes
+    return f"{st.st_ino}-{st.st_mtime_ns}-{st.st_size}"
+
+
+def _local_etag(full):
+    try:
+        st = os.stat(full)
+    except FileNotFoundError:
+        return None
+    return _stat_etag(st)
+
+
+def _local_write(path, data, if_match=None, if_absent=False):
+    """Write to a temp file next to the target, then rename over it (atomic)."""
+    full = _local_file(path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(full), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        with _write_lock, open(full + ".lock", "a") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)  # other processes sharing STORAGE_DIR
+            current = _local_etag(full)
+            if (if_match is not None and current != if_match) or (if_absent and current is not None):
+                raise PreconditionFailed(path)
+            os.replace(tmp, full)
+            etag = _local_etag(full)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return full, etag
+
+
+def _read(path, max_age):
+    """Cache entry for path (body _MISSING if it doesn't exist), or None if unreadable."""
+    entry = _cache.get(path)
+    if entry and time.monotonic() - entry["checked"] < max_age:
+        _count("hits")
+        return entry
+    with _trace.phase("blob-read", path=path):
+        return _load(path, entry)
+
+
+def _load(path, entry):
+    if BACKEND == "local":
+        try:
+            return _local_read(path, entry)
+        except (OSError, ValueError):
+            return None
+
+    # Known URL first (the one that worked last time), then the direct public URL
+    store_id = get_store_id()
+    url = entry["url"] if entry and entry.get("url") else None
+    if not url and store_id:
+        url = f"{BLOB_PUBLIC_URL.format(store_id=store_id)}/{path}"
+    if url:
+        try:
+            return _fetch(path, url, entry)
+        except _net.HTTPError as e:
+            if e.code == 404:
+                _count("misses")
+                return _remember(path, url, None, _MISSING)
+        except:
+            pass
+
+    # Fallback: list API to find the blob URL
+    try:
+        url = _resolve_url(path)
+        if url:
+            return _fetch(path, url, entry)
+    except:
+        pass
+    return None
+
+
+def read_json(path, default=None, max_age=None, strict=False):
+    """Read a JSON blob. Returns default if missing or unreadable.
+
+    max_age overrides READ_TTL for this read; 0 always revalidates (for
+    read-modify-write). strict: only a missing blob gives default; an
+    unreadable one raises IOError (as read_versioned does).
+    """
+    if not configured():
+        return default
+    entry = _read(path, READ_TTL if max_age is None else max_age)
+    if entry is None:
+        if strict:
+            raise IOError(f"No se pudo leer {path}")
+        return default
+    return _result(entry["body"], default)
+
+
+def read_versioned(path, default=None):
+    """Fresh read for read-modify-write. Returns (data, etag); etag is None if
+    the object doesn't exist (or the store gave no ETag)."""
+    # Body and etag from the same entry: another thread may refresh the cache meanwhile
+    entry = _read(path, 0) if configured() else None
+    if entry is None:
+        # Unreadable is not missing: writing default now could wipe the object
+        raise IOError(f"No se pudo leer {path}")
+    if entry["body"] is _MISSING:
+        return default, None
+    return copy.deepcopy(entry["body"]), entry["etag"]
+
+
+def write_json(path, data, if_match=None, if_absent=False):
+    """Write a JSON blob (overwrites, no random suffix).
+
+    With if_match (an etag from read_versioned) the write only happens if
+    the object is still at that version, with if_absent only if it doesn't
+    exist yet; otherwise PreconditionFailed.
+    """
+    with _trace.phase("blob-write", path=path):
+        return _write(path, data, if_match, if_absent)
+
+
+def _write(path, data, if_match, if_absent):
+    conditional = if_match is not None or if_absent
+    if BACKEND == "local":
+        full, etag = _local_write(path, data, if_match, if_absent)
+        _remember(path, full, etag, copy.deepcopy(data))
+        return {"url": "file://" + full, "pathname": path, "etag": etag}
+
+    headers = {
+        "Authorization": f"Bearer {BLOB_TOKEN}",
+        "Content-Type": "application/json",
+        "x-api-version": "7",
+        "x-content-type": "application/json",
+        "x-add-random-suffix": "0",
+    }
+    if if_match is not None:
+        headers["x-if-match"] = if_match
+    if if_absent:
+        headers["x-allow-overwrite"] = "0"
+    try:
+        # A conditional PUT must not be replayed blindly: a retry could overwrite a newer version
+        result = _net.request("PUT", f"{BLOB_API}/{path}", json_body=data, headers=headers, timeout=TIMEOUT,
+                              retries=0 if conditional else None).json() or {}
+    except _net.HTTPError as e:
+        if e.code in (409, 412):
+            invalidate(path)
+            raise PreconditionFailed(path)
+        raise
+    # Our own write is the freshest copy; the public URL may lag behind the CDN
+    _remember(path, result.get("url") or (_cache.get(path) or {}).get("url"), result.get("etag"), copy.deepcopy(data))
+    return result
+
+
+def update_json(path, fn, default=None):
+    """Read-modify-write with optimistic concurrency.
+
+    fn(current) returns the new document (current is default if the object
+    doesn't exist). If another writer got in between, fn is re-applied on
+    top of their version. Returns (new document, write result).
+    """
+    with _cache_lock:
+        lock = _update_locks.setdefault(path, threading.Lock())
+    with lock:
+        return _update(path, fn, default)
+
+
+def _update(path, fn, default):
+    for attempt in range(UPDATE_RETRIES):
+        entry = _cache.get(path)
+        if (attempt == 0 and entry and entry["etag"] and entry["body"] is not _MISSING
+                and time.monotonic() - entry["checked"] < READ_TTL):
+            # Recently seen version: write against it, a conflict costs the read
+            current, etag = copy.deepcopy(entry["body"]), entry["etag"]
+        else:
+            current, etag = read_versioned(path, _MISSING)
+        exists = current is not _MISSING
+        if not exists:
+            current = copy.deepcopy(default)
+        data = fn(current)
+        try:
+            return data, write_json(path, data, if_match=etag, if_absent=not exists)
+        except PreconditionFailed:
+            if attempt == UPDATE_RETRIES - 1:
+                raise
+            time.sleep(random.uniform(0, 0.02 * 2 ** attempt))  # spread out competing writers
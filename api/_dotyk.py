@@ -0,0 +1,320 @@
+"""Shared Dotyk client: one cached JWT per audience, Category PATCHes.
+
+Tokens are "Long" duration, so a warm instance reuses them until shortly
+before they expire instead of doing a password grant on every request.
+The dotyk.tech login session (its cookies) is cached the same way.
+Set DOTYK_TOKEN_CACHE=blob to also keep them in the Blob store, so cold
+instances can skip the grant and the login too.
+
+get_categories() is the live enabled/disabled state of every category
+(one GET), cached for CATEGORY_TTL seconds and dropped by our own PATCHes.
+"""
+import base64, hashlib, json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import _blob, _metrics, _net, _singleflight, _trace
+
+EMAIL = os.environ.get("DOTYK_EMAIL", "")
+PASSWORD = os.environ.get("DOTYK_PASSWORD", "")
+# Upstream URLs can be pointed elsewhere (e.g. the stand-ins in bench/)
+TOKEN_API = os.environ.get("DOTYK_TOKEN_API", "https://dotyk.me/api/v1.2/token/password")
+LOGIN_API = os.environ.get("DOTYK_LOGIN_API", "https://dotyk.tech/api/user/LoginWithDotykMe")
+RESTAURANT_API = os.environ.get("DOTYK_RESTAURANT_API", "https://eu.restaurant.dotyk.cloud")
+VENUE = "nua-barcelona"
+
+RESTAURANT_AUDIENCE = "https://eu.restaurant.dotyk.cloud/"
+TECH_AUDIENCE = "https://dotyk.tech/"
+
+REFRESH_MARGIN = 300   # seconds before exp at which we fetch a new token
+FALLBACK_TTL = 3600    # used when the JWT has no readable exp claim
+SESSION_TTL = 3600     # dotyk.tech session lifetime when its cookies carry no expiry
+PATCH_WORKERS = 6      # one per Smart Menú category
+CATEGORY_TTL = 15      # seconds the category snapshot is served from memory
+PERSIST = os.environ.get("DOTYK_TOKEN_CACHE", "").strip().lower() == "blob"
+
+_tokens = {}  # audience -> {"token": str, "exp": float}
+_rejected = set()  # tokens the upstream answered 401 to
+_session = {}  # {"cookie": str, "exp": float}: dotyk.tech login session
+_locks = {}
+_locks_guard = threading.Lock()
+_categories = {}  # {"items": [...], "at": monotonic, "fetchedAt": epoch}: last category snapshot
+_categories_gen = 0  # bumped by every PATCH: a GET that started earlier is not cached
+
+# Category PATCH workers; the pool only starts threads once something is submitted
+_executor = ThreadPoolExecutor(max_workers=PATCH_WORKERS, thread_name_prefix="dotyk-patch")
+
+
+def jwt_expiry(token):
+    """Return the exp claim (epoch seconds) of a JWT, or None."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp else None
+    except Exception:
+        return None
+
+
+def _is_fresh(entry, key="token"):
+    return (bool(entry) and bool(entry.get(key)) and entry[key] not in _rejected
+            and entry.get("exp", 0) - REFRESH_MARGIN > time.time())
+
+
+def _blob_path(audience):
+    # Blob URLs are public: derive the name from the store secret so it can't be guessed
+    digest = hashlib.sha256(f"{_blob.BLOB_TOKEN}|{EMAIL}|{audience}".encode()).hexdigest()[:32]
+    return f"auth/{digest}.json"
+
+
+def _lock_for(audience):
+    with _locks_guard:
+        return _locks.setdefault(audience, threading.Lock())
+
+
+def _request_token(audience, scope):
+    with _trace.phase("token"):
+        token_data = _net.post_json(TOKEN_API, {
+            "username": EMAIL,
+            "password": PASSWORD,
+            "duration": "Long",
+            "audience": audience,
+            "scope": scope
+        }, timeout=15) or {}
+    return token_data.get("token") or token_data.get("access_token")
+
+
+def get_token(audience, scope):
+    """Cached token for audience. Concurrent callers share a single grant."""
+    entry = _tokens.get(audience)
+    if _is_fresh(entry):
+        _metrics.incr("token.hit")
+        return entry["token"]
+
+    with _lock_for(audience):
+        entry = _tokens.get(audience)
+        if _is_fresh(entry):
+            _metrics.incr("token.hit")
+            return entry["token"]
+
+        if PERSIST and _blob.configured():
+            entry = _blob.read_json(_blob_path(audience))
+            if _is_fresh(entry):
+                _tokens[audience] = entry
+                _metrics.incr("token.blob")
+                return entry["token"]
+
+        _metrics.incr("token.grant")
+        token = _request_token(audience, scope)
+        if not token:
+            return None
+        entry = {"token": token, "exp": jwt_expiry(token) or time.time() + FALLBACK_TTL}
+        _tokens[audience] = entry
+
+        if PERSIST and _blob.configured():
+            try:
+                _blob.write_json(_blob_path(audience), entry)
+            except Exception:
+                pass  # cache only, the token is still good
+        return token
+
+
+def invalidate(audience, token=None):
+    """Drop a token the upstream rejected so the next call re-authenticates."""
+    entry = _tokens.get(audience)
+    if entry and token in (None, entry["token"]):
+        _tokens.pop(audience, None)
+        _rejected.add(entry["token"])
+    elif token:
+        _rejected.add(token)
+
+
+def get_restaurant_token():
+    return get_token(RESTAURANT_AUDIENCE, ["caud", "basic"])
+
+
+def get_tech_token():
+    return get_token(TECH_AUDIENCE, ["basic"])
+
+
+def with_token(audience, scope, fn):
+    """Call fn(token); on a 401 refresh the token once and retry."""
+    token = get_token(audience, scope)
+    if not token:
+        raise RuntimeError("Token vacio de dotyk.me")
+    try:
+        return fn(token)
+    except _net.HTTPError as e:
+        if e.code != 401:
+            raise
+        invalidate(audience, token)
+        token = get_token(audience, scope)
+        if not token:
+            raise
+        return fn(token)
+
+
+def _login_tech(token):
+    with _trace.phase("login"):
+        resp = _net.request("POST", LOGIN_API, body=f'"{token}"', headers={"Content-Type": "application/json"}, timeout=30)
+    cookie = _net.cookies_from(resp)
+    if not cookie:
+        raise RuntimeError("LoginWithDotykMe sin cookies de sesion")
+    return {"cookie": cookie, "exp": _net.cookie_expiry(resp) or time.time() + SESSION_TTL}
+
+
+def get_tech_session():
+    """Cookie header of a logged-in dotyk.tech session, reused until it expires."""
+    if _is_fresh(_session, "cookie"):
+        _metrics.incr("session.hit")
+        return _session["cookie"]
+
+    with _lock_for("session"):
+        if _is_fresh(_session, "cookie"):
+            _metrics.incr("session.hit")
+            return _session["cookie"]
+
+        path = _blob_path("session:" + TECH_AUDIENCE)
+        if PERSIST and _blob.configured():
+            entry = _blob.read_json(path)
+            if _is_fresh(entry, "cookie"):
+                _session.update(entry)
+                _metrics.incr("session.blob")
+                return entry["cookie"]
+
+        _metrics.incr("session.login")
+        entry = with_token(TECH_AUDIENCE, ["basic"], _login_tech)
+        _session.clear()
+        _session.update(entry)
+
+        if PERSIST and _blob.configured():
+            try:
+                _blob.write_json(path, entry)
+            except Exception:
+                pass
+        return entry["cookie"]
+
+
+def invalidate_tech_session(cookie):
+    if _session.get("cookie") == cookie:
+        _session.clear()
+    _rejected.add(cookie)
+
+
+def with_tech_session(fn):
+    """Call fn(cookie); on 401/403 log in again once (the token is only
+    re-granted if the login itself is rejected) and retry."""
+    cookie = get_tech_session()
+    try:
+        return fn(cookie)
+    except _net.HTTPError as e:
+        if e.code not in (401, 403):
+            raise
+        invalidate_tech_session(cookie)
+        return fn(get_tech_session())
+
+
+def invalidate_categories():
+    """Our own PATCH changed a category: the snapshot no longer holds."""
+    global _categories_gen
+    with _locks_guard:
+        _categories_gen += 1
+        _categories.clear()
+
+
+def get_categories(max_age=CATEGORY_TTL):
+    """Every category of the venue as {id: {"name", "isEnabled"}}, plus the
+    epoch seconds it was fetched. One upstream GET, shared by concurrent
+    callers and reused for max_age seconds (0 = always fetch)."""
+    with _locks_guard:
+        snapshot, gen = dict(_categories), _categories_gen
+    if snapshot and time.monotonic() - snapshot["at"] < max_age:
+        _metrics.incr("categories.hit")
+        return snapshot["items"], snapshot["fetchedAt"]
+
+    def fetch():
+        _metrics.incr("categories.fetch")
+        with _trace.phase("categories"):
+            resp = with_token(RESTAURANT_AUDIENCE, ["caud", "basic"], lambda token: _net.request(
+                "GET", f"{RESTAURANT_API}/{VENUE}/Category",
+                headers={"Authorization": f"Bearer {token}", "Accept": "application/json"}, timeout=10))
+        data = resp.json() or []
+        if isinstance(data, dict):
+            data = data.get("items") or data.get("value") or []
+        items = {}
+        for c in data:
+            cid = c.get("id") or c.get("Id")
+            if cid:
+                items[cid] = {"name": c.get("name") or c.get("Name"), "isEnabled": c.get("isEnabled", c.get("IsEnabled"))}
+        return items, time.time()
+
+    # Keyed by the generation so a caller after a PATCH never gets a GET from before it
+    items, fetched_at = _singleflight.do("categories", VENUE, gen, fetch, ttl=0)
+    with _locks_guard:
+        if _categories_gen == gen:
+            _categories.update(items=items, at=time.monotonic(), fetchedAt=fetched_at)
+    return items, fetched_at
+
+
+def patch_category(token, cat_id, cat_name, is_enabled, timeout=15):
+    """PATCH one category. Returns (status, body); raises _net.HTTPError on >= 400.
+
+    Identical PATCHes in flight at the same time (cron + admin, a double
+    tap) share one upstream call, see _singleflight.
+    """
+    def send():
+        invalidate_categories()
+        try:
+            with _trace.phase("patch"):
+                resp = _net.request(
+                    "PATCH", f"{RESTAURANT_API}/{VENUE}/Category",
+                    json_body={"id": cat_id, "name": cat_name, "isEnabled": is_enabled, "type": "Category"},
+                    headers={"Authorization": f"Bearer {token}"},
+                    timeout=timeout,
+                    retries=1  # setting isEnabled is idempotent
+                )
+        finally:
+            invalidate_categories()  # and again: a GET may have run while the PATCH was in flight
+        return resp.status, resp.text()
+    return _singleflight.do("patch", cat_id, {"name": cat_name, "isEnabled": is_enabled}, send)
+
+
+def patch_categories(ops):
+    """Run category PATCHes concurrently with one shared token.
+
+    ops: list of {"categoryId", "name", "isEnabled"}. Returns one result per
+    op, in order, with success/status/error and latency in ms.
+    """
+
+    def run(op):
+        started = time.monotonic()
+        result = {"categoryId": op["categoryId"], "name": op["name"], "isEnabled": op["isEnabled"]}
+        try:
+            status, _ = with_token(
+                RESTAURANT_AUDIENCE, ["caud", "basic"],
+                lambda token: patch_category(token, op["categoryId"], op["name"], op["isEnabled"])
+            )
+            result.update(success=True, status=status)
+        except _net.HTTPError as e:
+            result.update(success=False, status=e.code, error=f"PATCH {e.code}: {e.body.decode(errors='replace')[:300]}")
+        except Exception as e:
+            result.update(success=False, error=str(e))
+        result["ms"] = round((time.monotonic() - started) * 1000)
+        return result
+
+    return list(_executor.map(_trace.wrap(run), ops))
+
+
+def patch_with_parent(parent_op, child_ops):
+    """Apply a parent category and its children in a safe order.
+
+    The parent is enabled before the children and disabled after them, so
+    diners never see an enabled child under a hidden parent. Children run
+    concurrently. parent_op may be None. Results: parent first, then children.
+    """
+    if parent_op is None:
+        return patch_categories(child_ops)
+    if parent_op["isEnabled"]:
+        parent = patch_categories([parent_op])
+        return parent + patch_categories(child_ops)
+    children = patch_categories(child_ops)
+    return patch_categories([parent_op]) + children
@@ -0,0 +1,196 @@
+"""Persistent job queue for work that shouldn't block a request (publishing).
+
+Jobs live in one JSON object (JOBS_PATH) in the Blob store, or in
+STORAGE_DIR with the local backend, so any instance can report on them and
+a recycled instance loses nothing. Every change goes through update_json.
+
+A job is {"id", "kind", "status", "payload", "attempts", ...}; status is
+queued -> running -> done | failed, with "retrying" (and nextAttemptAt)
+between attempts. run() claims the due jobs under a lease, calls the
+runner registered for their kind and records the outcome; a job whose
+worker died is picked up again once its lease expires.
+
+Workers: POST /api/publish/run (the page kicks it right after enqueueing),
+the cron tick, and the local server's JobWorker thread (on_enqueue).
+Enqueue and settle keep the epoch of the next due attempt as "jobsDue" in
+the cron's marker, so a tick only reads JOBS_PATH when something is due.
+"""
+import time, uuid
+
+import _blob, _timeline
+
+JOBS_PATH = "jobs.json"
+MAX_ATTEMPTS = 4
+BACKOFF = 5  # seconds before the 2nd attempt, x3 for each one after
+LEASE = 150  # seconds a claim is valid (a publish is 3 x 30 s timeouts at worst)
+KEEP = 3600  # finished jobs are kept this long for /status
+MAX_KEPT = 50  # every change rewrites the whole object: keep it small
+
+on_enqueue = None  # callable(job): set by the local server to wake its worker
+
+ACTIVE = ("queued", "running", "retrying")
+
+
+def _now():
+    return time.time()
+
+
+def _prune(jobs, now):
+    finished = sorted((j for j in jobs.values() if j["status"] not in ACTIVE),
+                      key=lambda j: j["updatedAt"], reverse=True)
+    drop = {j["id"] for j in finished[MAX_KEPT:]}
+    drop |= {j["id"] for j in finished if now - j["updatedAt"] > KEEP}
+    return {k: v for k, v in jobs.items() if k not in drop}
+
+
+def _due(jobs):
+    """Epoch seconds of the next attempt (or expired lease) among jobs, or None."""
+    pending = [j.get("nextAttemptAt") if j["status"] != "running" else j.get("leaseUntil")
+               for j in jobs.values() if j["status"] in ACTIVE]
+    return min(pending) if pending else None
+
+
+def note_due(due):
+    """Record due as the marker's jobsDue if it isn't already.
+
+    Best effort: the page and the local worker run jobs without it; only
+    the cron's pick-up of an abandoned job waits for the next write.
+    """
+    marker = _blob.read_json(_timeline.MARKER_PATH, None)
+    if marker is not None and marker.get("jobsDue") == due:
+        return
+    try:
+        # No marker yet: dirty, so the cron still takes its full path
+        _blob.update_json(_timeline.MARKER_PATH, lambda m: dict(m, jobsDue=due), default={"dirty": True})
+    except Exception:
+        pass
+
+
+def _update(fn, note=False):
+    """Apply fn(jobs dict) under update_json; returns whatever fn returned last.
+    note: also record the resulting jobsDue in the marker."""
+    out = {}
+
+    def apply(doc):
+        jobs = dict(doc.get("jobs") or {})
+        out["value"] = fn(jobs)
+        out["jobs"] = _prune(jobs, _now())
+        return {"jobs": out["jobs"]}
+
+    _blob.update_json(JOBS_PATH, apply, default={"jobs": {}})
+    if note:
+        note_due(_due(out["jobs"]))
+    return out.get("value")
+
+
+def enqueue(kind, payload, max_attempts=MAX_ATTEMPTS):
+    """Store a new job and return it."""
+    now = _now()
+    job = {"id": uuid.uuid4().hex[:16], "kind": kind, "status": "queued", "payload": payload,
+           "attempts": 0, "maxAttempts": max_attempts, "createdAt": now, "updatedAt": now,
+           "nextAttemptAt": now, "error": None}
+
+    def add(jobs):
+        jobs[job["id"]] = job
+    _update(add, note=True)
+    if on_enqueue:
+        on_enqueue(job)
+    return job
+
+
+def _is_due(job, now):
+    if job["status"] in ("queued", "retrying"):
+        return job.get("nextAttemptAt", 0) <= now
+    return job["status"] == "running" and job.get("leaseUntil", 0) <= now  # its worker is gone
+
+
+def read_jobs(max_age=None):
+    return (_blob.read_json(JOBS_PATH, {}, max_age=max_age) or {}).get("jobs") or {}
+
+
+def get(job_id, max_age=0):
+    return read_jobs(max_age).get(job_id)
+
+
+def recent(limit=20):
+    jobs = sorted(read_jobs(0).values(), key=lambda j: j["createdAt"], reverse=True)
+    return jobs[:limit]
+
+
+def next_due():
+    """Epoch seconds of the next queued attempt, or None (for the local worker's sleep)."""
+    return _due(read_jobs())
+
+
+def public(job, now=None):
+    """The job as /api/publish/status shows it."""
+    now = _now() if now is None else now
+    out = {k: v for k, v in job.items() if k not in ("payload", "lease")}
+    if job["status"] in ("queued", "retrying"):
+        out["retryIn"] = max(0, round(job.get("nextAttemptAt", now) - now, 1))
+    return out
+
+
+def claim(job_id=None, kinds=None):
+    """Mark the due jobs (or just job_id, if due) running under a fresh lease."""
+    now = _now()
+
+    def wanted(j):
+        return ((job_id is None or j["id"] == job_id) and (kinds is None or j["kind"] in kinds)
+                and _is_due(j, now))
+
+    # A given job may have been enqueued on another instance moments ago: read it fresh
+    jobs = read_jobs(0 if job_id else None)
+    if not any(wanted(j) for j in jobs.values()):
+        if job_id is None:
+            note_due(_due(jobs))  # the cron polled: leave it the real next attempt
+        return []  # nothing to do: no write
+
+    def take(jobs):
+        claimed = []
+        for j in jobs.values():
+            if not wanted(j):
+                continue
+            j.update(status="running", attempts=j["attempts"] + 1, lease=uuid.uuid4().hex,
+                     leaseUntil=now + LEASE, startedAt=now, updatedAt=now)
+            claimed.append(dict(j))
+        return claimed
+    return _update(take) or []
+
+
+def settle(job, ok, result=None, error=None, retry=True):
+    """Record an attempt's outcome. Ignored if the lease was lost to another worker."""
+    now = _now()
+
+    def finish(jobs):
+        current = jobs.get(job["id"])
+        if current is None or current.get("lease") != job["lease"]:
+            return None
+        current.update(result or {})
+        current.update(updatedAt=now, error=error, lease=None, leaseUntil=None)
+        if ok:
+            current.update(status="done", finishedAt=now)
+        elif retry and current["attempts"] < current["maxAttempts"]:
+            current.update(status="retrying", nextAttemptAt=now + BACKOFF * 3 ** (current["attempts"] - 1))
+        else:
+            current.update(status="failed", finishedAt=now)
+        return dict(current)
+    return _update(finish, note=True)
+
+
+def run(runners, job_id=None):
+    """Claim and run the due jobs whose kind has a runner.
+
+    runners: kind -> fn(job) returning (ok, result dict, error, retry).
+    Returns the settled jobs.
+    """
+    done = []
+    for job in claim(job_id, kinds=set(runners)):
+        try:
+            ok, result, error, retry = runners[job["kind"]](job)
+        except Exception as e:
+            ok, result, error, retry = False, None, str(e), True
+        settled = settle(job, ok, result, error, retry)
+        if settled:
+            done.append(settled)
+    return done
@@ -0,0 +1,207 @@
+"""In-process metrics for the api/* handlers, flushed to the Blob store.
+
+Every outbound call (via _trace.call) and every handled request lands in a
+5-minute slot: count, errors, summed ms and a latency histogram with fixed
+buckets, per upstream (token, login, patch, start, blob-read, blob-write)
+and per handler (api/<name>). Counters cover cache hits, token grants,
+logins and cold starts.
+
+Serverless instances are recycled, so at most every FLUSH_INTERVAL seconds
+the unflushed part is merged into METRICS_PATH (update_json), which keeps
+the last RETENTION of slots. /api/metrics reads that plus what this
+instance hasn't flushed yet.
+"""
+import os, threading, time, uuid
+
+# _blob is imported where it's used: _net -> _trace -> _metrics runs when the
+# local server starts, and _blob reads its env (token, backend) on import,
+# which must wait until server.py has applied config.json.
+
+METRICS_PATH = "metrics.json"
+SLOT = 300  # seconds per slot
+RETENTION = 24 * 3600
+FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "60"))
+BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]  # ms upper bounds, + overflow
+
+INSTANCE = uuid.uuid4().hex[:8]
+STARTED = time.time()
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_slots = {}  # str(slot start) -> {key: {"n", "err", "ms", "b": [...]}}, not flushed yet
+_counters = {"cold_starts": 1}  # not flushed yet
+_blob_seen = {}  # _blob.cache_stats() at the last flush
+_last_flush = time.monotonic()
+
+
+def _bucket(ms):
+    for i, bound in enumerate(BUCKETS):
+        if ms <= bound:
+            return i
+    return len(BUCKETS)
+
+
+def _empty():
+    return {"n": 0, "err": 0, "ms": 0.0, "b": [0] * (len(BUCKETS) + 1)}
+
+
+def _add(t, s):
+    t["n"] += s["n"]
+    t["err"] += s["err"]
+    t["ms"] = round(t["ms"] + s["ms"], 1)
+    t["b"] = [a + b for a, b in zip(t["b"], s["b"])]
+
+
+def observe(key, ms, error=False):
+    """One timed operation for key (an upstream or api/<handler>)."""
+    slot = str(int(time.time() // SLOT * SLOT))
+    with _lock:
+        s = _slots.setdefault(slot, {}).setdefault(key, _empty())
+        s["n"] += 1
+        s["err"] += 1 if error else 0
+        s["ms"] = round(s["ms"] + ms, 1)
+        s["b"][_bucket(ms)] += 1
+
+
+def incr(name, n=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def _merge_slots(into, slots):
+    for slot, keys in slots.items():
+        target = into.setdefault(slot, {})
+        for key, s in keys.items():
+            _add(target.setdefault(key, _empty()), s)
+
+
+def _merge(doc, slots, counters):
+    doc = dict(doc or {})
+    merged = dict(doc.get("slots") or {})
+    _merge_slots(merged, slots)
+    cutoff = time.time() - RETENTION
+    doc["slots"] = {k: v for k, v in merged.items() if int(k) >= cutoff}
+    totals = dict(doc.get("counters") or {})
+    for name, n in counters.items():
+        totals[name] = totals.get(name, 0) + n
+    doc["counters"] = totals
+    doc.setdefault("since", STARTED)
+    return doc
+
+
+def _blob_delta():
+    """Blob cache counters since the last flush, as blob.* counters."""
+    import _blob
+    stats = _blob.cache_stats()
+    delta = {f"blob.{k}": n - _blob_seen.get(k, 0) for k, n in stats.items() if n - _blob_seen.get(k, 0)}
+    _blob_seen.update(stats)
+    return delta
+
+
+def _take():
+    global _slots, _counters
+    with _lock:
+        slots, counters = _slots, _counters
+        _slots, _counters = {}, {}
+        for name, n in _blob_delta().items():
+            counters[name] = counters.get(name, 0) + n
+    return slots, counters
+
+
+def _put_back(slots, counters):
+    with _lock:
+        _merge_slots(_slots, slots)
+        for name, n in counters.items():
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def flush():
+    """Merge the unflushed slots and counters into METRICS_PATH."""
+    global _last_flush
+    import _blob
+    if not _blob.configured():
+        return
+    with _flush_lock:
+        _last_flush = time.monotonic()
+        slots, counters = _take()
+        if not slots and not counters:
+            return
+        try:
+            _blob.update_json(METRICS_PATH, lambda doc: _merge(doc, slots, counters), default={})
+        except Exception:
+            _put_back(slots, counters)  # try again next time
+
+
+def maybe_flush():
+    """Flush in the background if FLUSH_INTERVAL has passed (called after each request)."""
+    if time.monotonic() - _last_flush >= FLUSH_INTERVAL and not _flush_lock.locked():
+        threading.Thread(target=flush, name="metrics-flush", daemon=True).start()
+
+
+def _percentile(buckets, p):
+    """Upper bound (ms) of the bucket holding percentile p; past the last
+    bound, a label like ">30000" (JSON has no Infinity)."""
+    total = sum(buckets)
+    if not total:
+        return None
+    rank = p / 100 * total
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= rank:
+            return BUCKETS[i] if i < len(BUCKETS) else f">{BUCKETS[-1]}"
+    return None
+
+
+def report(window=3600):
+    """Stored metrics plus this instance's unflushed part, summarised over the last window seconds."""
+    import _blob
+    doc = _blob.read_json(METRICS_PATH, {}, max_age=FLUSH_INTERVAL) if _blob.configured() else {}
+    with _lock:
+        pending = {k: {key: dict(s, b=list(s["b"])) for key, s in v.items()} for k, v in _slots.items()}
+        pending_counters = dict(_counters)
+        stats = _blob.cache_stats()
+        for k, n in stats.items():
+            if n - _blob_seen.get(k, 0):
+                pending_counters[f"blob.{k}"] = pending_counters.get(f"blob.{k}", 0) + n - _blob_seen.get(k, 0)
+    doc = _merge(doc, pending, pending_counters)
+
+    cutoff = time.time() - window
+    totals = {}
+    for slot, entries in doc["slots"].items():
+        if int(slot) + SLOT <= cutoff:
+            continue
+        for key, s in entries.items():
+            _add(totals.setdefault(key, _empty()), s)
+
+    out = {}
+    for key, s in sorted(totals.items()):
+        out[key] = {
+            "count": s["n"],
+            "errors": s["err"],
+            "errorRate": round(s["err"] / s["n"], 4) if s["n"] else 0,
+            "meanMs": round(s["ms"] / s["n"], 1) if s["n"] else None,
+            "p50": _percentile(s["b"], 50),
+            "p95": _percentile(s["b"], 95),
+            "p99": _percentile(s["b"], 99),
+            "histogram": dict(zip([f"<={b}" for b in BUCKETS] + [f">{BUCKETS[-1]}"], s["b"])),
+        }
+
+    counters = doc["counters"]
+    cache = {}
+    for name, hit, misses in (("blob", "blob.hits", ("blob.revalidated", "blob.misses")),
+                              ("token", "token.hit", ("token.blob", "token.grant")),
+                              ("session", "session.hit", ("session.blob", "session.login"))):
+        hits = counters.get(hit, 0)
+        total = hits + sum(counters.get(m, 0) for m in misses)
+        cache[name] = dict({"hits": hits, "hitRatio": round(hits / total, 4) if total else None},
+                           **{m.split(".")[1]: counters.get(m, 0) for m in misses})
+    return {
+        "window": window,
+        "since": doc.get("since"),
+        "instance": {"id": INSTANCE, "startedAt": STARTED, "uptime": round(time.time() - STARTED)},
+        "upstreams": {k: v for k, v in out.items() if not k.startswith("api/")},
+        "handlers": {k[4:]: v for k, v in out.items() if k.startswith("api/")},
+        "cache": cache,
+        "counters": counters,
+    }
@@ -0,0 +1,335 @@
+"""Shared HTTP client for the api/* handlers.
+
+Keeps a small pool of keep-alive connections per host and one SSL context
+for the whole process, so warm invocations skip the TCP connect and TLS
+handshake to dotyk.me, eu.restaurant.dotyk.cloud, dotyk.tech and the Blob
+store. Idempotent calls are retried with backoff.
+
+Every host also gets a circuit breaker and an adaptive timeout. After
+BREAKER_FAILURES consecutive failures (no response, 5xx, 429) calls to it
+fail at once with CircuitOpen for a cool-down, then a single probe decides
+whether it closes again. The timeout passed by the caller is the ceiling:
+once a host has enough samples, TIMEOUT_FACTOR x its p95 latency is used
+(never under TIMEOUT_FLOOR), so a degraded host costs seconds, not 30 s.
+"""
+import collections, email.utils, http.client, http.cookies, io, json, random, ssl, threading, time, urllib.error, urllib.parse
+
+import _trace
+
+
+def _ssl_ctx():
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+SSL_CTX = _ssl_ctx()
+DEFAULT_TIMEOUT = 15
+MAX_IDLE_PER_HOST = 8
+IDEMPOTENT = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+RETRY_STATUS = {429, 502, 503, 504}
+BACKOFF = 0.2  # seconds, doubled on every retry
+USER_AGENT = "Mozilla/5.0"
+
+BREAKER_FAILURES = 5  # consecutive failures that open a host's breaker
+BREAKER_COOLDOWN = 10  # seconds open before a probe; doubled while probes fail
+BREAKER_MAX_COOLDOWN = 120
+TIMEOUT_SAMPLES = 50  # recent latencies kept per host
+TIMEOUT_MIN_SAMPLES = 20
+TIMEOUT_FACTOR = 5
+TIMEOUT_FLOOR = 3.0  # seconds
+
+_pools = {}  # (scheme, netloc) -> [idle connections]
+_pools_lock = threading.Lock()
+
+# Errors that mean a pooled connection went stale (server closed it while idle)
+_STALE = (http.client.RemoteDisconnected, http.client.CannotSendRequest, ConnectionResetError, BrokenPipeError)
+
+
+class HTTPError(urllib.error.HTTPError):
+    """Non-2xx response. Subclasses urllib's so existing handlers keep working."""
+
+    def __init__(self, url, status, reason, headers, body):
+        super().__init__(url, status, reason, headers, io.BytesIO(body))
+        self.body = body
+
+
+class CircuitOpen(ConnectionError):
+    """The host's breaker is open: the call was not attempted."""
+
+    def __init__(self, host, retry_in):
+        super().__init__(f"{host} no disponible (circuito abierto, reintento en {retry_in:.0f} s)")
+        self.host = host
+        self.retry_in = retry_in
+
+
+class _Host:
+    """Breaker state and recent latencies of one host."""
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.state = "closed"  # closed | open | half-open
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.open_until = 0.0
+        self.probing = False
+        self.probe_started = 0.0
+        self.rejected = 0
+        self.latencies = collections.deque(maxlen=TIMEOUT_SAMPLES)  # seconds
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "open" and now >= self.open_until:
+                self.state, self.probing = "half-open", False
+            if self.probing and now - self.probe_started > BREAKER_MAX_COOLDOWN:
+                self.probing = False  # the probe never reported back
+            if self.state == "closed" or (self.state == "half-open" and not self.probing):
+                if self.state == "half-open":
+                    self.probing, self.probe_started = True, now
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_in(self):
+        with self.lock:
+            if self.state == "closed":
+                return 0.0
+            return max(0.0, self.open_until - time.monotonic())
+
+    def success(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.failures = 0
+            self.state, self.probing, self.cooldown = "closed", False, BREAKER_COOLDOWN
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half-open":
+                self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+            elif self.state == "closed" and self.failures < BREAKER_FAILURES:
+                return
+            elif self.state == "open":
+                return
+            self.state, self.probing = "open", False
+            self.open_until = time.monotonic() + self.cooldown
+
+    def p95(self):
+        with self.lock:
+            samples = sorted(self.latencies)
+        if len(samples) < TIMEOUT_MIN_SAMPLES:
+            return None
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    def timeout(self, ceiling):
+        p95 = self.p95()
+        if p95 is None:
+            return ceiling
+        return min(ceiling, max(TIMEOUT_FLOOR, p95 * TIMEOUT_FACTOR))
+
+    def status(self):
+        p95 = self.p95()
+        with self.lock:
+            state, failures, rejected = self.state, self.failures, self.rejected
+        return {"state": state, "failures": failures, "rejected": rejected,
+                "retryIn": round(self.retry_in(), 1),
+                "p95Ms": round(p95 * 1000) if p95 is not None else None,
+                "timeout": round(self.timeout(DEFAULT_TIMEOUT), 1)}
+
+
+_hosts = {}  # netloc -> _Host
+_hosts_lock = threading.Lock()
+
+
+def _host(url):
+    netloc = urllib.parse.urlsplit(url).netloc
+    with _hosts_lock:
+        h = _hosts.get(netloc)
+        if h is None:
+            h = _hosts[netloc] = _Host(netloc)
+        return h
+
+
+def retry_in(url):
+    """Seconds until url's host takes calls again (0 if its breaker is closed)."""
+    return _host(url).retry_in()
+
+
+def breaker_state():
+    """host -> breaker state, failures, p95 and the timeout currently used."""
+    with _hosts_lock:
+        hosts = list(_hosts.values())
+    return {h.host: h.status() for h in hosts}
+
+
+def breaker_header():
+    """Hosts whose breaker isn't closed, for the X-Upstream-Breakers header ("" if none)."""
+    with _hosts_lock:
+        hosts = list(_hosts.values())
+    return ", ".join(f"{h.host}={h.state}" for h in hosts if h.state != "closed")
+
+
+class Response:
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def text(self):
+        return self.body.decode(errors="replace")
+
+    def json(self):
+        return json.loads(self.body.decode()) if self.body else None
+
+
+def _take(key, timeout):
+    with _pools_lock:
+        idle = _pools.get(key)
+        if idle:
+            conn = idle.pop()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+    scheme, netloc = key
+    if scheme == "https":
+        return http.client.HTTPSConnection(netloc, timeout=timeout, context=SSL_CTX), False
+    return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+
+def _give_back(key, conn):
+    with _pools_lock:
+        idle = _pools.setdefault(key, [])
+        if len(idle) < MAX_IDLE_PER_HOST:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def _send(method, url, body, headers, timeout):
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    while True:
+        conn, reused = _take(key, timeout)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except _STALE:
+            conn.close()
+            if reused:
+                continue  # stale keep-alive connection, the request never got through
+            raise
+        except Exception:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            _give_back(key, conn)
+        return Response(url, resp.status, resp.reason, resp.headers, data)
+
+
+def request(method, url, body=None, headers=None, timeout=DEFAULT_TIMEOUT, retries=None, json_body=None):
+    """Send a request over a pooled connection. Returns a Response.
+
+    Raises HTTPError for status >= 400. Idempotent methods are retried
+    (2 times by default) on connection errors, timeouts and 429/5xx.
+    Raises CircuitOpen without calling out while the host's breaker is open;
+    timeout is the ceiling for the host's adaptive timeout.
+    """
+    method = method.upper()
+    headers = dict(headers or {})
+    headers.setdefault("User-Agent", USER_AGENT)
+    if json_body is not None:
+        body = json.dumps(json_body, ensure_ascii=False).encode("utf-8")
+        headers.setdefault("Content-Type", "application/json")
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if retries is None:
+        retries = 2 if method in IDEMPOTENT else 0
+
+    attempt = 0
+    redirects = 0
+    while True:
+        host = _host(url)
+        if not host.allow():
+            raise CircuitOpen(host.host, host.retry_in())
+        started = time.perf_counter()
+        try:
+            resp = _send(method, url, body, headers, host.timeout(timeout))
+        except (OSError, http.client.HTTPException) as e:
+            host.failure()
+            _trace.call(method, url, None, body, None, started, error=e)
+            if attempt >= retries or host.state != "closed":
+                raise
+        else:
+            if resp.status >= 500 or resp.status == 429:
+                host.failure()
+            else:
+                host.success(time.perf_counter() - started)
+            _trace.call(method, url, resp.status, body, resp.body, started)
+            if resp.status in (301, 302, 303, 307, 308) and method in ("GET", "HEAD") and redirects < 3:
+                url = urllib.parse.urljoin(url, resp.headers.get("Location", ""))
+                redirects += 1
+                continue
+            if resp.status < 400:
+                return resp
+            if resp.status not in RETRY_STATUS or attempt >= retries or host.state != "closed":
+                raise HTTPError(url, resp.status, resp.reason, resp.headers, resp.body)
+        attempt += 1
+        time.sleep(BACKOFF * (2 ** (attempt - 1)) * (1 + random.random() / 2))
+
+
+def get_json(url, **kwargs):
+    return request("GET", url, **kwargs).json()
+
+
+def post_json(url, data, **kwargs):
+    return request("POST", url, json_body=data, **kwargs).json()
+
+
+def cookies_from(resp, existing=""):
+    """Merge the Set-Cookie headers of resp into a Cookie header value."""
+    jar = http.cookies.SimpleCookie()
+    if existing:
+        jar.load(existing)
+    for header in resp.headers.get_all("Set-Cookie") or []:
+        try:
+            jar.load(header)
+        except http.cookies.CookieError:
+            pass
+    return "; ".join(f"{k}={m.value}" for k, m in jar.items())
+
+
+def cookie_expiry(resp):
+    """Earliest expiry (epoch seconds) among the Set-Cookie headers of resp, or None."""
+    jar = http.cookies.SimpleCookie()
+    for header in resp.headers.get_all("Set-Cookie") or []:
+        try:
+            jar.load(header)
+        except http.cookies.CookieError:
+            pass
+    expiries = []
+    for morsel in jar.values():
+        if morsel["max-age"]:
+            try:
+                expiries.append(time.time() + int(morsel["max-age"]))
+                continue
+            except ValueError:
+                pass
+        if morsel["expires"]:
+            try:
+                expiries.append(email.utils.parsedate_to_datetime(morsel["expires"]).timestamp())
+            except (TypeError, ValueError):
+                pass
+    return min(expiries) if expiries else None
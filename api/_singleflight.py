@@ -0,0 +1,78 @@
+"""Single-flight for Dotyk operations.
+
+A double-tap in the page, or the cron and an admin applying the same
+change together, would otherwise send the same PATCH/start/grant several
+times at once. do(op, target, payload, fn) runs fn once per identical
+(op, target, payload): callers arriving while it is in flight wait and get
+the same result (or exception), and a success is reused for RESULT_TTL
+seconds. A different payload for the same target (enable after disable)
+always goes upstream and drops the cached result of the old one.
+
+Per process only: that covers the local server and a warm serverless
+instance, where the overlaps happen.
+"""
+import hashlib, json, threading, time
+
+import _metrics
+
+RESULT_TTL = 3.0  # seconds a successful result answers identical calls
+
+_calls = {}  # (op, target, payload hash) -> _Call
+_lock = threading.Lock()
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.expires = None  # monotonic time the result stops being reused
+
+
+def _key(op, target, payload):
+    digest = hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return op, str(target), digest
+
+
+def invalidate(op, target=None):
+    """Forget finished results for op (and target): the upstream state changed."""
+    with _lock:
+        for k in [k for k, c in _calls.items()
+                  if k[0] == op and (target is None or k[1] == str(target)) and c.event.is_set()]:
+            del _calls[k]
+
+
+def do(op, target, payload, fn, ttl=RESULT_TTL):
+    """fn() once for concurrent identical calls; its result is shared."""
+    key = _key(op, target, payload)
+    now = time.monotonic()
+    with _lock:
+        for k in [k for k, c in _calls.items() if c.event.is_set() and c.expires <= now]:
+            del _calls[k]
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+            # A new payload for this target: older results no longer describe it
+            for k in [k for k, c in _calls.items() if k[:2] == key[:2] and k != key and c.event.is_set()]:
+                del _calls[k]
+
+    if not leader:
+        _metrics.incr(f"singleflight.{op}." + ("cached" if call.event.is_set() else "shared"))
+        call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = fn()
+        return call.result
+    except BaseException as e:
+        call.error = e
+        with _lock:
+            if _calls.get(key) is call:
+                del _calls[key]  # failures are shared with the waiters, never cached
+        raise
+    finally:
+        call.expires = time.monotonic() + ttl
+        call.event.set()
@@ -0,0 +1,181 @@
+"""Schedule rules compiled into a weekly timeline.
+
+The week is split at every rule start/end into segments, each with the set
+of menu IDs active during it. Finding the active set for a moment is then
+a bisect over minute-of-week boundaries, and the same arrays give the next
+transition. Compiled timelines are cached per rules version.
+"""
+import hashlib, json
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+MARKER_PATH = "schedule_marker.json"
+STATE_PATH = "cron_state.json"  # cron runtime state, kept out of schedule.json
+STATE_KEYS = ("lastAction", "lastCronRun", "categoryState", "nextTransition", "pendingOps", "failedOps")
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+_compiled = {}  # version -> compiled timeline
+
+
+def madrid_now():
+    """Get current time in Europe/Madrid timezone."""
+    if ZoneInfo:
+        return datetime.now(ZoneInfo("Europe/Madrid"))
+    # Fallback: CET = UTC+1 (doesn't handle DST perfectly)
+    return datetime.now(timezone(timedelta(hours=1)))
+
+
+def rules_version(rules):
+    return hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def _minutes(hhmm):
+    h, m = hhmm.split(":")[:2]
+    return int(h) * 60 + int(m)
+
+
+def compile_rules(rules, default_menu_ids):
+    """Compile rules into {"version", "starts": [minute-of-week], "states": [[menu ids]]}.
+
+    Same semantics as the rule scan it replaces: a rule covers
+    startTime <= time < endTime on each of its days (0=Monday), inactive
+    rules are ignored and rules without menuIds use default_menu_ids.
+    """
+    intervals = []
+    for rule in rules:
+        if not rule.get("active", True):
+            continue
+        start = _minutes(rule.get("startTime", "00:00"))
+        end = _minutes(rule.get("endTime", "23:59"))
+        if end <= start:
+            continue
+        menus = rule.get("menuIds", default_menu_ids)
+        for day in rule.get("days", []):
+            base = int(day) * MINUTES_PER_DAY
+            intervals.append((base + start, base + end, menus))
+
+    points = sorted({0} | {p for s, e, _ in intervals for p in (s, e) if p < MINUTES_PER_WEEK})
+    starts, states = [], []
+    for i, point in enumerate(points):
+        active = set()
+        for s, e, menus in intervals:
+            if s <= point < e:
+                active.update(menus)
+        state = sorted(active)
+        if states and states[-1] == state:
+            continue  # merge segments with the same active set
+        starts.append(point)
+        states.append(state)
+    return {"version": rules_version(rules), "starts": starts, "states": states}
+
+
+def get_compiled(schedule, default_menu_ids):
+    """Compiled timeline for a schedule: in-memory cache, then the copy stored
+    alongside schedule.json, then compile."""
+    rules = schedule.get("rules", [])
+    version = rules_version(rules)
+    compiled = _compiled.get(version)
+    if compiled is None:
+        stored = schedule.get("compiled")
+        if stored and stored.get("version") == version:
+            compiled = stored
+        else:
+            compiled = compile_rules(rules, default_menu_ids)
+        _compiled.clear()  # only the current version is useful
+        _compiled[version] = compiled
+    return compiled
+
+
+def minute_of_week(now):
+    return now.weekday() * MINUTES_PER_DAY + now.hour * 60 + now.minute
+
+
+def active_at(compiled, now):
+    """Set of menu IDs active at now."""
+    i = bisect_right(compiled["starts"], minute_of_week(now)) - 1
+    return set(compiled["states"][i])
+
+
+def next_transition(compiled, now):
+    """Datetime (same tz as now) of the next change of active set, or None if it never changes."""
+    starts, states = compiled["starts"], compiled["states"]
+    n = len(starts)
+    mow = minute_of_week(now)
+    i = bisect_right(starts, mow)
+    current = states[i - 1]
+    for k in range(i, i + n):
+        # The last segment wraps into Monday 00:00, which may hold the same set
+        if states[k % n] != current:
+            point = starts[k % n] + (MINUTES_PER_WEEK if k >= n else 0)
+            return now.replace(second=0, microsecond=0) + timedelta(minutes=point - mow)
+    return None
+
+
+def state_basis(schedule):
+    """What a cron state was computed against: the rules version and the
+    moment scheduling was last switched on or off (enabledAt)."""
+    return {"rulesVersion": rules_version(schedule.get("rules", [])), "enabledAt": schedule.get("enabledAt")}
+
+
+def cron_view(schedule, state):
+    """schedule.json + cron_state.json as one document (the pre-split shape).
+
+    lastAction only counts for the rules and enabled switch it was applied
+    to; categoryState is dropped when scheduling was switched since (menus
+    may have been toggled by hand). state None means no cron_state.json yet:
+    the fields still stored in schedule.json are used as is.
+    """
+    view = {k: v for k, v in schedule.items() if k not in STATE_KEYS}
+    if state is None:
+        state = dict({k: schedule.get(k) for k in STATE_KEYS}, **state_basis(schedule))
+    basis = state_basis(schedule)
+    same_switch = state.get("enabledAt") == basis["enabledAt"]
+    same_rules = same_switch and state.get("rulesVersion") == basis["rulesVersion"]
+    view["lastAction"] = state.get("lastAction") if same_rules else None
+    view["lastCronRun"] = state.get("lastCronRun")
+    view["categoryState"] = (state.get("categoryState") or {}) if same_switch else {}
+    view["nextTransition"] = state.get("nextTransition") if same_rules else None
+    # Queued category retries (cron.py) belong to the switch they were queued under
+    view["pendingOps"] = (state.get("pendingOps") or {}) if same_switch else {}
+    view["failedOps"] = state.get("failedOps") or []
+    return view
+
+
+def build_marker(schedule, now, default_menu_ids, retry_at=None):
+    """Tiny summary the cron checks before loading schedule.json.
+
+    schedule is the combined cron_view() document.
+
+    While not dirty and now < nextTransition (epoch seconds) the cron has
+    nothing to do. dirty means the applied state is unknown (lastAction
+    reset by an admin save). retry_at (epoch seconds) brings nextTransition
+    forward for a transition that failed and has to be tried again.
+    """
+    next_ts = None
+    if schedule.get("enabled"):
+        nxt = next_transition(get_compiled(schedule, default_menu_ids), now)
+        next_ts = nxt.timestamp() if nxt else None
+        if retry_at is not None:
+            next_ts = retry_at if next_ts is None else min(next_ts, retry_at)
+    return {
+        "version": rules_version(schedule.get("rules", [])),
+        "enabled": bool(schedule.get("enabled")),
+        "dirty": bool(schedule.get("enabled")) and schedule.get("lastAction") is None,
+        "nextTransition": next_ts,
+    }
+
+
+def marker_allows_skip(marker, now):
+    """True if the marker proves this tick is a no-op."""
+    if not marker or marker.get("dirty"):
+        return False
+    if not marker.get("enabled"):
+        return True
+    nxt = marker.get("nextTransition")
+    return nxt is None or now.timestamp() < nxt
@@ -0,0 +1,172 @@
+"""Per-request timing for the api/* handlers.
+
+A handler calls begin() when a request comes in; from then on every
+outbound call made through _net is recorded (method, host, path, status,
+bytes, ms), tagged with the phase it ran in (token, login, patch, start,
+blob-read, blob-write). send_json() then calls finish(), which gives the
+Server-Timing header, an optional "timings" block (?timings=1 or
+X-Timings: 1) and one JSON line on stdout for the Vercel log drain
+(TRACE_LOG=0 turns that off).
+
+The trace lives in a contextvar, so worker threads only see it when the
+task is submitted through wrap(). Calls and finished requests also feed
+_metrics, traced or not (the scheduler thread has no trace).
+"""
+import contextlib, contextvars, json, os, sys, threading, time, urllib.parse
+
+import _metrics
+
+LOG = os.environ.get("TRACE_LOG", "1") != "0"
+
+_trace = contextvars.ContextVar("trace", default=None)
+_phase = contextvars.ContextVar("phase", default=None)
+
+
+class Trace:
+    def __init__(self, name, detail=False):
+        self.name = name
+        self.detail = detail
+        self.started = time.perf_counter()
+        self.phases = []  # {"phase", "ms", ...attrs}
+        self.calls = []  # {"phase", "method", "host", "path", "status", "sent", "received", "ms", "error"?}
+        self.lock = threading.Lock()
+
+    def add(self, kind, item):
+        with self.lock:
+            getattr(self, kind).append(item)
+
+    def total_ms(self):
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def summary(self):
+        """phase -> {"ms": summed duration, "count"}. Concurrent phases (the
+        parallel PATCHes) add up, so the sum can exceed the request time."""
+        out = {}
+        with self.lock:
+            for p in self.phases:
+                s = out.setdefault(p["phase"], {"ms": 0.0, "count": 0})
+                s["ms"] = round(s["ms"] + p["ms"], 1)
+                s["count"] += 1
+        return out
+
+    def server_timing(self):
+        parts = [f'{name};dur={s["ms"]};desc="{s["count"]}x"' for name, s in self.summary().items()]
+        parts.append(f"total;dur={self.total_ms()}")
+        return ", ".join(parts)
+
+    def payload(self):
+        with self.lock:
+            calls = list(self.calls)
+        return {"total_ms": self.total_ms(), "phases": self.summary(), "calls": calls}
+
+
+def begin(handler, name):
+    """Start the trace for a request. handler is the BaseHTTPRequestHandler (or None)."""
+    detail = False
+    if handler is not None:
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(handler.path).query)
+        detail = query.get("timings", [""])[0] == "1" or handler.headers.get("X-Timings") == "1"
+    trace = Trace(name, detail)
+    _trace.set(trace)
+    _phase.set(None)
+    return trace
+
+
+def current():
+    return _trace.get()
+
+
+def finish(status):
+    """End the current trace: logs it and returns it (None if there was none)."""
+    trace = _trace.get()
+    if trace is None:
+        return None
+    _trace.set(None)
+    _metrics.observe("api/" + trace.name, trace.total_ms(), error=status >= 500)
+    _metrics.maybe_flush()
+    if LOG:
+        line = {"type": "trace", "handler": trace.name, "status": status, "total_ms": trace.total_ms(),
+                "phases": trace.summary(), "calls": trace.calls}
+        sys.stdout.write(json.dumps(line) + "\n")
+        sys.stdout.flush()
+    return trace
+
+
+def headers(trace, data):
+    """(Server-Timing value, payload) for send_json; adds "timings" when asked for."""
+    if trace is None:
+        return None, data
+    if trace.detail and isinstance(data, dict):
+        data = dict(data, timings=trace.payload())
+    return trace.server_timing(), data
+
+
+def send_json(handler, code, data, blob_cache=False, ensure_ascii=True, extra=None):
+    """Finish the trace and write data as the JSON response, with the headers
+    every api/* handler sends: CORS, X-Upstream-Breakers while a host is
+    unhealthy, Server-Timing, and X-Blob-Cache if blob_cache. extra: more
+    headers (name -> value)."""
+    import _blob, _net  # imported here: _net imports this module
+    timing, data = headers(finish(code), data)
+    handler.send_response(code)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Access-Control-Allow-Origin", "*")
+    for name, value in (extra or {}).items():
+        handler.send_header(name, value)
+    if blob_cache:
+        handler.send_header("X-Blob-Cache", ", ".join(f"{k}={v}" for k, v in _blob.cache_stats().items()))
+    breakers = _net.breaker_header()
+    if breakers:
+        handler.send_header("X-Upstream-Breakers", breakers)
+    if timing:
+        handler.send_header("Server-Timing", timing)
+    handler.end_headers()
+    handler.wfile.write(json.dumps(data, ensure_ascii=ensure_ascii).encode())
+
+
+@contextlib.contextmanager
+def phase(name, **attrs):
+    """Time a block; outbound calls inside it are tagged with name."""
+    trace = _trace.get()
+    token = _phase.set(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phase.reset(token)
+        if trace is not None:
+            trace.add("phases", dict(attrs, phase=name, ms=round((time.perf_counter() - started) * 1000, 1)))
+
+
+def call(method, url, status, sent, received, started, error=None):
+    """Record one outbound HTTP attempt (called by _net)."""
+    parts = urllib.parse.urlsplit(url)
+    ms = round((time.perf_counter() - started) * 1000, 1)
+    # 4xx is an answer (a missing blob, a rejected token), not an upstream failure
+    _metrics.observe(_phase.get() or parts.netloc, ms, error=status is None or status >= 500 or status == 429)
+    trace = _trace.get()
+    if trace is None:
+        return
+    item = {
+        "phase": _phase.get(),
+        "method": method,
+        "host": parts.netloc,
+        "path": parts.path,
+        "status": status,
+        "sent": len(sent or b""),
+        "received": len(received or b""),
+        "ms": ms,
+    }
+    if error is not None:
+        item["error"] = f"{type(error).__name__}: {error}"[:200]
+    trace.add("calls", item)
+
+
+def wrap(fn):
+    """fn bound to the caller's context, for executor.submit/map: the worker
+    thread records into the same trace."""
+    ctx = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+    return run
@@ -1,24 +1,29 @@
 from http.server import BaseHTTPRequestHandler
-import json, os, ssl, urllib.request, urllib.parse
-from datetime import datetime, timedelta, timezone
-try:
-    from zoneinfo import ZoneInfo
-except ImportError:
-    ZoneInfo = None
+import os, sys, time, urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _blob, _dotyk, _net, _timeline, _trace, publish
 
 CRON_SECRET = os.environ.get("CRON_SECRET", "").strip()
-BLOB_TOKEN = os.environ.get("BLOB_READ_WRITE_TOKEN", "")
 SCHEDULE_PATH = "schedule.json"
-
-# Dotyk API config (duplicated from menus.py for serverless isolation)
-EMAIL = os.environ.get("DOTYK_EMAIL", "")
-PASSWORD = os.environ.get("DOTYK_PASSWORD", "")
-TOKEN_API = "https://dotyk.me/api/v1.2/token/password"
-RESTAURANT_API = "https://eu.restaurant.dotyk.cloud"
+STATE_PATH = _timeline.STATE_PATH
+MARKER_PATH = _timeline.MARKER_PATH
+# A warm instance trusts its cached marker until its nextTransition, but for at
+# most MARKER_MAX_AGE. That is below the 60 s cron period, so each tick
+# revalidates it (If-None-Match: a 304 while it is unchanged) and an admin
+# save, made from another function on Vercel, is applied on the next tick.
+MARKER_MAX_AGE = 50
+OP_MAX_ATTEMPTS = 5  # a category PATCH is given up on (failedOps) after this many tries
+OP_BACKOFF = 30  # seconds before the first retry, doubled after each failure
+OP_MAX_BACKOFF = 900
+FAILED_KEEP = 20  # given-up ops kept in cron_state.json for inspection
+
+# Dotyk API config (credentials and token cache live in _dotyk.py)
+EMAIL = _dotyk.EMAIL
+PASSWORD = _dotyk.PASSWORD
+RESTAURANT_API = _dotyk.RESTAURANT_API
 VENUE = "nua-barcelona"
 
-BLOB_API = "https://blob.vercel-storage.com"
-
 # Parent category
 PARENT_CATEGORY_ID = "7037dd01-8e70-4571-8857-6295f01c8862"
 PARENT_CATEGORY_NAME = "Smart Menús"
@@ -39,147 +44,300 @@ DEFAULT_MENU_IDS = [
     "782e61b7-9cc9-48e2-b5be-b78876692929",   # Crea tu Smart Menú
 ]
 
-def ssl_ctx():
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    return ctx
+def category_name(cat_id):
+    if cat_id == PARENT_CATEGORY_ID:
+        return PARENT_CATEGORY_NAME
+    return ALL_MENU_IDS.get(cat_id, cat_id)
 
 def get_madrid_now():
     """Get current time in Europe/Madrid timezone."""
-    if ZoneInfo:
-        return datetime.now(ZoneInfo("Europe/Madrid"))
-    # Fallback: CET = UTC+1 (doesn't handle DST perfectly)
-    return datetime.now(timezone(timedelta(hours=1)))
-
-def get_store_id():
-    """Extract store ID from token: vercel_blob_rw_STOREID_..."""
-    parts = BLOB_TOKEN.split("_")
-    if len(parts) >= 4:
-        return parts[3]
-    return None
+    return _timeline.madrid_now()
 
 def read_schedule():
-    default = {"enabled": False, "rules": [], "lastAction": None, "lastCronRun": None}
-    if not BLOB_TOKEN:
-        return default
+    """schedule.json (owned by the admin) combined with cron_state.json (owned by the cron).
+    Raises IOError if either exists but can't be read: a missing schedule is
+    a disabled one, an unreadable one is not."""
+    default = {"enabled": False, "rules": []}
+    return _timeline.cron_view(_blob.read_json(SCHEDULE_PATH, default, strict=True),
+                               _blob.read_json(STATE_PATH, None, strict=True))
+
+def public_ops(pending):
+    """pendingOps as the cron response shows them (the same list on every path)."""
+    return [{"name": op["name"], "isEnabled": op["isEnabled"], "attempts": op["attempts"],
+             "nextAttempt": op["nextAttempt"], "lastError": op["lastError"]}
+            for op in pending.values()]
+
+def next_retry(pending):
+    """Epoch seconds of the earliest queued retry, or None."""
+    return min((op["nextAttempt"] for op in pending.values()), default=None)
+
+def settle_ops(pending, results, now_ts, wait=0):
+    """Fold PATCH results into the pending ops (categoryId -> op).
+
+    A success ends the op; a failure (re)queues it with exponential backoff
+    (at least wait, the breaker's cool-down) until OP_MAX_ATTEMPTS, then it
+    is given up. Results marked skipped weren't sent and cost no attempt.
+    Returns (pending, ids that succeeded on a retry, ops given up).
+    """
+    pending = dict(pending)
+    done, failed = [], []
+    for r in results:
+        cid = r["categoryId"]
+        op = pending.pop(cid, None) or {"categoryId": cid, "name": r["name"], "attempts": 0, "since": now_ts}
+        if r["success"]:
+            if op["attempts"]:
+                done.append(cid)
+            continue
+        attempts = op["attempts"] + (0 if r.get("skipped") else 1)
+        if attempts >= OP_MAX_ATTEMPTS:
+            failed.append(dict(op, isEnabled=r["isEnabled"], attempts=attempts, lastError=r["error"], gaveUpAt=now_ts))
+            continue
+        delay = max(wait, min(OP_BACKOFF * 2 ** max(attempts - 1, 0), OP_MAX_BACKOFF))
+        pending[cid] = dict(op, isEnabled=r["isEnabled"], attempts=attempts, lastError=r["error"], nextAttempt=now_ts + delay)
+    return pending, done, failed
+
+def save_state(schedule, results, drop=(), wait=0, **fields):
+    """Record a tick in cron_state.json. Only this small object is written;
+    a concurrent manual toggle (menus.py) is kept and our results re-applied on top.
+    Returns (state, write result, {"done", "failed"} from settle_ops)."""
+    basis = _timeline.state_basis(schedule)
+    now_ts = time.time()
+    outcome = {}
+
+    def apply(current):
+        same_switch = current.get("enabledAt") == basis["enabledAt"]
+        known = dict(current.get("categoryState") or {}) if same_switch else {}
+        for r in results:
+            if r["success"]:
+                known[r["categoryId"]] = r["isEnabled"]
+            else:
+                # Failed categories become unknown so they get patched again
+                known.pop(r["categoryId"], None)
+        pending = {cid: op for cid, op in (current.get("pendingOps") or {}).items() if cid not in drop} if same_switch else {}
+        pending, outcome["done"], outcome["failed"] = settle_ops(pending, results, now_ts, wait)
+        failed_ops = (outcome["failed"] + list(current.get("failedOps") or []))[:FAILED_KEEP]
+        return dict(current, categoryState=known, pendingOps=pending, failedOps=failed_ops, **basis, **fields)
+
+    # Before the first save the view still carries the state stored in schedule.json
+    state, result = _blob.update_json(STATE_PATH, apply, default=dict(basis, categoryState=schedule.get("categoryState") or {}))
+    return state, result, outcome
+
+def read_marker(now):
+    """(marker, etag). A cached marker that allows skipping is used as is
+    (etag None); otherwise the tick may rewrite it, so it is read fresh.
+    etag is False if the marker couldn't be read: it isn't rewritten then."""
+    marker = _blob.read_json(MARKER_PATH, None, max_age=MARKER_MAX_AGE)
+    if _timeline.marker_allows_skip(marker, now):
+        return marker, None
+    try:
+        return _blob.read_versioned(MARKER_PATH, None)
+    except IOError:
+        return None, False
+
+def refresh_marker(schedule, now, read, retry_at=None):
+    """Write the next-transition marker if it changed. Returns it.
 
-    store_id = get_store_id()
-    if store_id:
+    read is read_marker()'s (marker, etag): the write only replaces that
+    version. If an admin save rewrote it meanwhile (new rules, dirty), ours
+    was built from the old rules and is dropped. jobsDue (kept by _jobs)
+    is carried over.
+    """
+    cached, etag = read
+    marker = _timeline.build_marker(schedule, now, DEFAULT_MENU_IDS, retry_at)
+    if cached and "jobsDue" in cached:
+        marker["jobsDue"] = cached["jobsDue"]
+    if marker != cached and etag is not False:
         try:
-            url = f"https://{store_id}.public.blob.vercel-storage.com/{SCHEDULE_PATH}"
-            req = urllib.request.Request(url)
-            with urllib.request.urlopen(req, context=ssl_ctx(), timeout=10) as r:
-                return json.loads(r.read().decode())
-        except urllib.error.HTTPError as e:
-            if e.code == 404:
-                return default
-        except:
-            pass
+            _blob.write_json(MARKER_PATH, marker, if_match=etag, if_absent=cached is None)
+        except Exception:
+            pass  # PreconditionFailed or unreachable: next tick takes the full path again
+    return marker
 
-    try:
-        req = urllib.request.Request(
-            f"{BLOB_API}?prefix={SCHEDULE_PATH}",
-            headers={"Authorization": f"Bearer {BLOB_TOKEN}"},
-            method="GET"
-        )
-        with urllib.request.urlopen(req, context=ssl_ctx(), timeout=10) as r:
-            data = json.loads(r.read().decode())
-            blobs = data.get("blobs", [])
-            if blobs:
-                blob_file_url = blobs[0].get("url", "")
-                if blob_file_url:
-                    req2 = urllib.request.Request(blob_file_url)
-                    with urllib.request.urlopen(req2, context=ssl_ctx(), timeout=10) as r2:
-                        return json.loads(r2.read().decode())
-    except:
-        pass
-    return default
-
-def write_schedule(schedule_data):
-    body = json.dumps(schedule_data, ensure_ascii=False).encode("utf-8")
-    req = urllib.request.Request(
-        f"{BLOB_API}/{SCHEDULE_PATH}",
-        data=body,
-        headers={
-            "Authorization": f"Bearer {BLOB_TOKEN}",
-            "Content-Type": "application/json",
-            "x-api-version": "7",
-            "x-content-type": "application/json",
-            "x-add-random-suffix": "0",
-        },
-        method="PUT"
-    )
-    with urllib.request.urlopen(req, context=ssl_ctx(), timeout=10) as r:
-        return json.loads(r.read().decode())
+def jobs_due(now_ts):
+    """True if the marker says a publish job is due: only then is jobs.json read.
+    The marker is the one this tick already has in cache."""
+    due = (_blob.read_json(MARKER_PATH, None, max_age=MARKER_MAX_AGE) or {}).get("jobsDue")
+    return due is not None and due <= now_ts
 
 def get_restaurant_token():
-    req = urllib.request.Request(
-        TOKEN_API,
-        data=json.dumps({
-            "username": EMAIL, "password": PASSWORD,
-            "duration": "Long",
-            "audience": f"{RESTAURANT_API}/",
-            "scope": ["caud", "basic"]
-        }).encode(),
-        headers={"Content-Type": "application/json", "User-Agent": "Mozilla/5.0"},
-        method="POST"
-    )
-    with urllib.request.urlopen(req, context=ssl_ctx(), timeout=15) as r:
-        token_data = json.loads(r.read().decode())
-        return token_data.get("token") or token_data.get("access_token")
+    return _dotyk.get_restaurant_token()
 
 def patch_category(jwt_token, cat_id, cat_name, is_enabled):
-    url = f"{RESTAURANT_API}/{VENUE}/Category"
-    payload = {"id": cat_id, "name": cat_name, "isEnabled": is_enabled, "type": "Category"}
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(payload).encode(),
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {jwt_token}",
-            "User-Agent": "Mozilla/5.0"
-        },
-        method="PATCH"
-    )
-    with urllib.request.urlopen(req, context=ssl_ctx(), timeout=15) as resp:
-        return resp.status
+    status, _ = _dotyk.patch_category(jwt_token, cat_id, cat_name, is_enabled)
+    return status
+
+def live_category_state():
+    """categoryId -> isEnabled as Dotyk has it now (cached snapshot, one GET
+    at most), or None if it can't be read: then categoryState is used."""
+    try:
+        items, _ = _dotyk.get_categories()
+    except Exception:
+        return None
+    return {cid: item["isEnabled"] for cid, item in items.items() if isinstance(item.get("isEnabled"), bool)}
+
+def upstream_wait():
+    """Seconds until the Dotyk hosts the cron needs take calls again (0 = now)."""
+    return max(_net.retry_in(_dotyk.TOKEN_API), _net.retry_in(RESTAURANT_API))
+
+def unhealthy_breakers():
+    return {host: s for host, s in _net.breaker_state().items() if s["state"] != "closed"}
 
 def get_active_menu_ids(schedule, now):
     """
     Returns which menu IDs should be active right now based on schedule rules.
     Returns None if scheduling is disabled.
     Returns a set of menu IDs that should be enabled (empty set = all disabled).
+    Rules are compiled once per version into a weekly timeline (see _timeline.py).
     """
     if not schedule.get("enabled"):
         return None  # Schedule disabled, don't act
 
-    weekday = now.weekday()  # 0=Monday ... 6=Sunday
-    current_time = now.strftime("%H:%M")
+    return _timeline.active_at(_timeline.get_compiled(schedule, DEFAULT_MENU_IDS), now)
 
-    active_ids = set()
-    any_rule_matched = False
 
-    for rule in schedule.get("rules", []):
-        if not rule.get("active", True):
-            continue
-        if weekday in rule.get("days", []):
-            start = rule.get("startTime", "00:00")
-            end = rule.get("endTime", "23:59")
-            if start <= current_time < end:
-                any_rule_matched = True
-                # Get menu IDs for this rule (fallback to defaults for backward compat)
-                rule_menus = rule.get("menuIds", DEFAULT_MENU_IDS)
-                for mid in rule_menus:
-                    active_ids.add(mid)
+def reconcile(now=None):
+    """One scheduler tick: bring Dotyk in line with the schedule at now.
 
-    if any_rule_matched:
-        return active_ids
-    return set()  # No rule matched = disable all
+    Returns (status code, payload). Shared by the /api/cron handler and the
+    scheduler thread of the local server; payloads carry nextTransition
+    (epoch seconds, None if nothing is due) when the schedule is known.
+    """
+    if not _blob.configured():
+        return 500, {"error": "BLOB_TOKEN not configured"}
+
+    now = now or get_madrid_now()
+    now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+
+    # Fast path: the marker (cached in memory) says nothing is due before the next transition
+    marker, etag = read_marker(now)
+    if _timeline.marker_allows_skip(marker, now):
+        return 200, {
+            "action": "none",
+            "reason": "schedule disabled" if not marker.get("enabled") else "no transition due",
+            "nextTransition": marker.get("nextTransition"),
+            "time": now_str
+        }
+
+    # Read schedule. Unreadable: no verdict on this tick, and the marker is left alone
+    try:
+        schedule = read_schedule()
+    except IOError as e:
+        return 503, {"error": f"Schedule: {e}", "time": now_str}
+
+    # Determine desired state
+    active_menu_ids = get_active_menu_ids(schedule, now)
+
+    if active_menu_ids is None:
+        # Schedule disabled - no schedule write needed, just respond
+        refresh_marker(schedule, now, (marker, etag))
+        return 200, {"action": "none", "reason": "schedule disabled", "nextTransition": None, "time": now_str}
+
+    # Build desired state as a sorted string for comparison
+    desired_state = ",".join(sorted(active_menu_ids)) if active_menu_ids else "none"
+    last_state = schedule.get("lastAction")
+
+    # Failed PATCHes from earlier ticks wait in pendingOps until their nextAttempt
+    now_ts = time.time()
+    pending = schedule.get("pendingOps") or {}
+    due = {cid for cid, op in pending.items() if op["nextAttempt"] <= now_ts}
+
+    if desired_state == last_state and not due:
+        # Already in desired state - no schedule write needed (saves 1 operation)
+        current = refresh_marker(schedule, now, (marker, etag), next_retry(pending))
+        return 200, {"action": "none", "reason": "already in desired state", "pendingOps": public_ops(pending),
+                     "nextTransition": current["nextTransition"], "time": now_str}
+
+    # State change needed
+    if not EMAIL or not PASSWORD:
+        return 500, {"error": "Dotyk credentials not configured"}
+
+    has_any_active = len(active_menu_ids) > 0
+
+    # Desired state per category. The parent is enabled if any menu is active.
+    desired = {PARENT_CATEGORY_ID: has_any_active}
+    for cat_id in ALL_MENU_IDS:
+        desired[cat_id] = cat_id in active_menu_ids
+
+    # What Dotyk really has (the menus snapshot) beats what we last recorded;
+    # categoryState is the fallback when the snapshot can't be read
+    live = live_category_state() if not upstream_wait() else None
+    known = dict(schedule.get("categoryState") or {}, **(live or {}))
+
+    # On a transition, only PATCH categories whose known state differs (unknown = patch)
+    changed = {}
+    if desired_state != last_state:
+        changed = {cid: on for cid, on in desired.items() if known.get(cid) != on}
+    skipped = [category_name(cid) for cid in desired if cid not in changed]
+
+    # Queued ops the schedule no longer wants are dropped; the due ones go out with the rest,
+    # unless the snapshot shows they took effect after all
+    superseded = [cid for cid, op in pending.items() if desired.get(cid) != op["isEnabled"]]
+    retried = {cid: desired[cid] for cid in due if cid not in superseded and cid not in changed}
+    confirmed = [cid for cid, on in retried.items() if live is not None and live.get(cid) == on]
+    ops = {cid: on for cid, on in dict(changed, **retried).items() if cid not in confirmed}
+
+    # Children go out concurrently; the parent is enabled before them and disabled after.
+    parent_op = None
+    if PARENT_CATEGORY_ID in ops:
+        parent_op = {"categoryId": PARENT_CATEGORY_ID, "name": PARENT_CATEGORY_NAME, "isEnabled": ops[PARENT_CATEGORY_ID]}
+    child_ops = [{"categoryId": cid, "name": ALL_MENU_IDS[cid], "isEnabled": on}
+                 for cid, on in ops.items() if cid in ALL_MENU_IDS]
+
+    # Dotyk down: don't wait out the timeouts, queue everything for when the breaker lets calls through
+    wait = upstream_wait() if ops else 0
+    token = True
+    if ops and not wait:
+        try:
+            token = get_restaurant_token()
+        except _net.CircuitOpen as e:
+            wait = e.retry_in
+    if not token:
+        return 500, {"error": "Could not get Dotyk token"}
+    if wait:
+        error = f"Dotyk no disponible (circuito abierto, {wait:.0f} s)"
+        results = [dict(op, success=False, error=error, ms=0, skipped=True)
+                   for op in ([parent_op] if parent_op else []) + child_ops]
+    else:
+        results = _dotyk.patch_with_parent(parent_op, child_ops)
+    results += [{"categoryId": cid, "name": category_name(cid), "isEnabled": retried[cid], "success": True,
+                 "ms": 0, "skipped": True} for cid in confirmed]
+    errors = [f"{r['name']}: {r['error']}" for r in results if not r["success"]]
+    latency_ms = {r["name"]: r["ms"] for r in results if not r.get("skipped")}
+
+    # The transition counts as applied; what failed stays queued in pendingOps
+    next_marker = _timeline.build_marker(dict(schedule, lastAction=desired_state), now, DEFAULT_MENU_IDS)
+    state, _, outcome = save_state(schedule, results, drop=superseded, wait=wait, lastAction=desired_state,
+                                   lastCronRun=now_str, nextTransition=next_marker["nextTransition"])
+    current = refresh_marker(_timeline.cron_view(schedule, state), now, (marker, etag), next_retry(state["pendingOps"]))
+
+    enabled_names = [ALL_MENU_IDS[mid] for mid in active_menu_ids if mid in ALL_MENU_IDS]
+
+    resp = {
+        "action": "deferred" if wait else ("updated" if desired_state != last_state else "retried"),
+        "enabled_menus": enabled_names,
+        "time": now_str,
+        "skipped": skipped,
+        "latency_ms": latency_ms,
+        "nextTransition": current["nextTransition"],
+        "pendingOps": public_ops(state["pendingOps"]),
+    }
+    if outcome["done"]:
+        resp["retried_ok"] = [category_name(cid) for cid in outcome["done"]]
+    if outcome["failed"]:
+        resp["given_up"] = [op["name"] for op in outcome["failed"]]
+    if superseded:
+        resp["superseded"] = [category_name(cid) for cid in superseded]
+    if errors:
+        resp["partial_errors"] = errors
+        resp["breakers"] = unhealthy_breakers()
+    else:
+        resp["categories_updated"] = len(results)
+    return 200, resp
 
 
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
+        _trace.begin(self, "cron")
         try:
             # Verify secret (Vercel sends Authorization: Bearer <CRON_SECRET>)
             auth_header = self.headers.get("Authorization", "")
@@ -193,87 +351,20 @@ class handler(BaseHTTPRequestHandler):
                 self.send_json(401, {"error": "Unauthorized"})
                 return
 
-            if not BLOB_TOKEN:
-                self.send_json(500, {"error": "BLOB_TOKEN not configured"})
-                return
-
-            # Read schedule
-            schedule = read_schedule()
-            now = get_madrid_now()
-            now_str = now.strftime("%Y-%m-%d %H:%M:%S")
-
-            # Determine desired state
-            active_menu_ids = get_active_menu_ids(schedule, now)
-
-            if active_menu_ids is None:
-                # Schedule disabled - no Blob write needed, just respond
-                self.send_json(200, {"action": "none", "reason": "schedule disabled", "time": now_str})
-                return
-
-            # Build desired state as a sorted string for comparison
-            desired_state = ",".join(sorted(active_menu_ids)) if active_menu_ids else "none"
-            last_state = schedule.get("lastAction")
-
-            if desired_state == last_state:
-                # Already in desired state - no Blob write needed (saves 1 operation)
-                self.send_json(200, {"action": "none", "reason": "already in desired state", "time": now_str})
-                return
-
-            # State change needed
-            if not EMAIL or not PASSWORD:
-                self.send_json(500, {"error": "Dotyk credentials not configured"})
-                return
-
-            jwt_token = get_restaurant_token()
-            if not jwt_token:
-                self.send_json(500, {"error": "Could not get Dotyk token"})
-                return
-
-            errors = []
-            has_any_active = len(active_menu_ids) > 0
-
-            # Parent category: enable if any menu is active, disable otherwise
+            code, payload = reconcile()
+            # Publicaciones pendientes de reintento (la cola vive en jobs.json; el marcador dice si hay)
+            ran = []
             try:
-                patch_category(jwt_token, PARENT_CATEGORY_ID, PARENT_CATEGORY_NAME, has_any_active)
+                if jobs_due(time.time()):
+                    ran = publish.run_jobs()
             except Exception as e:
-                errors.append(f"{PARENT_CATEGORY_NAME}: {str(e)}")
-
-            # Each child menu: enable only if in active set
-            for cat_id, cat_name in ALL_MENU_IDS.items():
-                try:
-                    should_enable = cat_id in active_menu_ids
-                    patch_category(jwt_token, cat_id, cat_name, should_enable)
-                except Exception as e:
-                    errors.append(f"{cat_name}: {str(e)}")
-
-            # Update schedule state
-            schedule["lastAction"] = desired_state
-            schedule["lastCronRun"] = now_str
-            write_schedule(schedule)
-
-            enabled_names = [ALL_MENU_IDS[mid] for mid in active_menu_ids if mid in ALL_MENU_IDS]
-
-            if errors:
-                self.send_json(200, {
-                    "action": "updated",
-                    "enabled_menus": enabled_names,
-                    "time": now_str,
-                    "partial_errors": errors
-                })
-            else:
-                self.send_json(200, {
-                    "action": "updated",
-                    "enabled_menus": enabled_names,
-                    "time": now_str,
-                    "categories_updated": len(ALL_MENU_IDS) + 1
-                })
+                payload["publishJobsError"] = str(e)
+            if ran:
+                payload["publishJobs"] = [{"id": j["id"], "status": j["status"], "attempts": j["attempts"]} for j in ran]
+            self.send_json(code, payload)
 
         except Exception as e:
             self.send_json(500, {"error": f"Cron: {str(e)}"})
 
     def send_json(self, code, data):
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        _trace.send_json(self, code, data, blob_cache=True)
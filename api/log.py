@@ -1,25 +1,20 @@
 from http.server import BaseHTTPRequestHandler
-import json, os, ssl, urllib.request
+import json, os, sys, urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 
-BLOB_TOKEN = os.environ.get("BLOB_READ_WRITE_TOKEN", "")
-BLOB_API = "https://blob.vercel-storage.com"
-LOG_PATH = "performance_logs.json"
-MAX_LOGS = 100
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _blob, _trace
 
+LOG_PATH = "performance_logs.json"  # legacy single array, newest first (read-only now)
+LOG_DIR = "logs"                     # one append-only shard per Madrid day: logs/YYYY-MM-DD.json
+INDEX_PATH = f"{LOG_DIR}/index.json"  # {"days": [newest, ..., oldest], "counts": {day: counts}}
+MAX_LOGS = 100                       # entries returned by GET without parameters
+PAGE_SIZE = 20                       # default ?limit= for paginated queries
+COUNT_DAYS = 90                      # days whose counts the index keeps (the page asks for 30)
+SHARD_READERS = 6                    # day shards downloaded at once by an aggregate
 
-def ssl_ctx():
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    return ctx
-
-
-def get_store_id():
-    parts = BLOB_TOKEN.split("_")
-    if len(parts) >= 4:
-        return parts[3]
-    return None
+_shard_pool = ThreadPoolExecutor(max_workers=SHARD_READERS, thread_name_prefix="log-shards")
 
 
 def madrid_now():
@@ -45,62 +40,190 @@ def madrid_now():
 
 
 def read_logs():
-    """Read logs from Vercel Blob. Returns empty list if not found."""
-    if not BLOB_TOKEN:
-        return []
+    """Read the legacy single-array log. Returns empty list if not found."""
+    return _blob.read_json(LOG_PATH, [])
 
-    store_id = get_store_id()
-    if store_id:
-        try:
-            url = f"https://{store_id}.public.blob.vercel-storage.com/{LOG_PATH}"
-            req = urllib.request.Request(url)
-            with urllib.request.urlopen(req, context=ssl_ctx(), timeout=10) as r:
-                return json.loads(r.read().decode())
-        except urllib.error.HTTPError as e:
-            if e.code == 404:
-                return []
-        except:
-            pass
-
-    # Fallback: list API
-    try:
-        req = urllib.request.Request(
-            f"{BLOB_API}?prefix={LOG_PATH}",
-            headers={"Authorization": f"Bearer {BLOB_TOKEN}"},
-            method="GET"
-        )
-        with urllib.request.urlopen(req, context=ssl_ctx(), timeout=10) as r:
-            data = json.loads(r.read().decode())
-            blobs = data.get("blobs", [])
-            if blobs:
-                blob_url = blobs[0].get("url", "")
-                if blob_url:
-                    req2 = urllib.request.Request(blob_url)
-                    with urllib.request.urlopen(req2, context=ssl_ctx(), timeout=10) as r2:
-                        return json.loads(r2.read().decode())
-    except:
-        pass
-
-    return []
-
-
-def write_logs(logs):
-    """Write logs JSON to Vercel Blob."""
-    body = json.dumps(logs, ensure_ascii=False).encode("utf-8")
-    req = urllib.request.Request(
-        f"{BLOB_API}/{LOG_PATH}",
-        data=body,
-        headers={
-            "Authorization": f"Bearer {BLOB_TOKEN}",
-            "Content-Type": "application/json",
-            "x-api-version": "7",
-            "x-content-type": "application/json",
-            "x-add-random-suffix": "0",
-        },
-        method="PUT"
-    )
-    with urllib.request.urlopen(req, context=ssl_ctx(), timeout=10) as r:
-        return json.loads(r.read().decode())
+
+def shard_path(day):
+    return f"{LOG_DIR}/{day}.json"
+
+
+def read_index():
+    index = _blob.read_json(INDEX_PATH, {})
+    return {"days": index.get("days", []), "counts": index.get("counts", {})}
+
+
+def make_entry(body):
+    """Log entry from the fields the page sends (POST /api/log, or a publish job)."""
+    return {
+        "video_name": body.get("video_name", ""),
+        "video_id": body.get("video_id", ""),
+        "table_names": body.get("table_names", ""),
+        "table_ids": body.get("table_ids", ""),
+        "table_count": body.get("table_count", 0),
+        "role": body.get("role", ""),
+        "activated_at_madrid": madrid_now()
+    }
+
+
+def empty_counts():
+    return {"total": 0, "byVideo": {}, "byTable": {}, "byHour": {}}
+
+
+def count_entry(counts, entry):
+    """Add entry to counts (empty_counts() shape), in place."""
+    counts["total"] += 1
+    video = entry.get("video_name") or entry.get("video_id") or "?"
+    counts["byVideo"][video] = counts["byVideo"].get(video, 0) + 1
+    for table in (entry.get("table_names") or "").split(","):
+        table = table.strip()
+        if table:
+            counts["byTable"][table] = counts["byTable"].get(table, 0) + 1
+    hour = entry.get("activated_at_madrid", "")[11:13]
+    if hour:
+        counts["byHour"][hour] = counts["byHour"].get(hour, 0) + 1
+
+
+def merge_counts(into, counts):
+    into["total"] += counts["total"]
+    for key in ("byVideo", "byTable", "byHour"):
+        for k, n in counts[key].items():
+            into[key][k] = into[key].get(k, 0) + n
+
+
+def append_log(entry):
+    """Append one entry to its day shard and add it to that day's counts in
+    the index, so aggregates over whole days don't download the shards."""
+    day = entry["activated_at_madrid"][:10]
+    # Versioned writes: two publishes landing together both keep their entry
+    _blob.update_json(shard_path(day), lambda shard: shard + [entry], default=[])
+
+    oldest = (datetime.strptime(day, "%Y-%m-%d") - timedelta(days=COUNT_DAYS)).strftime("%Y-%m-%d")
+
+    def add(index):
+        counts = {d: c for d, c in (index.get("counts") or {}).items() if d > oldest}
+        # A day whose shard predates the counts has none: it stays read from its shard
+        if day in counts or day not in index.get("days", []):
+            counts[day] = counts.get(day) or empty_counts()
+            count_entry(counts[day], entry)
+        return {"days": sorted(set(index.get("days", [])) | {day}, reverse=True), "counts": counts}
+    _blob.update_json(INDEX_PATH, add, default={})
+
+
+def iter_logs(cursor=None, date_from="", date_to=""):
+    """Yield (position, entry) newest first.
+
+    position is a cursor that resumes right after entry: "DAY:i" where i is
+    the index (in append order) of the next entry to return, or "legacy:i".
+    Shards are append-only, so positions stay valid as new entries arrive.
+    Day shards outside [date_from, date_to] are never downloaded.
+    """
+    start_day, start_i = None, None
+    if cursor:
+        start_day, _, i = cursor.rpartition(":")
+        start_i = int(i)
+
+    if start_day != "legacy":
+        for day in read_index()["days"]:
+            if start_day and day > start_day:
+                continue
+            if date_to and day > date_to[:10]:
+                continue
+            if date_from and day < date_from[:10]:
+                return  # days are newest first and legacy entries are older still
+            shard = _blob.read_json(shard_path(day), [])
+            i = start_i if day == start_day else len(shard)
+            for i in range(min(i, len(shard)) - 1, -1, -1):
+                yield f"{day}:{i}", shard[i]
+
+    legacy = read_logs()
+    first = start_i if start_day == "legacy" else 0
+    for i in range(first, len(legacy)):
+        yield f"legacy:{i + 1}", legacy[i]
+
+
+def matches(entry, q):
+    """Apply the role / video_id / table / from / to filters of a query."""
+    if q.get("role") and entry.get("role") != q["role"]:
+        return False
+    if q.get("video_id") and entry.get("video_id") != q["video_id"]:
+        return False
+    if q.get("table"):
+        tables = [t.strip() for t in f"{entry.get('table_ids', '')},{entry.get('table_names', '')}".split(",")]
+        if q["table"] not in tables:
+            return False
+    ts = entry.get("activated_at_madrid", "")
+    if q.get("from") and ts < q["from"]:
+        return False
+    # A bare date as upper bound includes the whole day
+    if q.get("to") and ts[:len(q["to"])] > q["to"]:
+        return False
+    return True
+
+
+def query_logs(q):
+    """One page of filtered entries: {"entries": [...], "nextCursor": str|None}."""
+    limit = max(1, min(int(q.get("limit") or PAGE_SIZE), 500))
+    entries, next_cursor = [], None
+    for position, entry in iter_logs(q.get("cursor"), q.get("from", ""), q.get("to", "")):
+        if not matches(entry, q):
+            continue
+        if len(entries) == limit:
+            break
+        entries.append(entry)
+        next_cursor = position
+    else:
+        next_cursor = None
+    return {"entries": entries, "nextCursor": next_cursor}
+
+
+def whole_day(day, q):
+    """True if every entry of day passes q: its counts can stand in for the shard."""
+    if q.get("role") or q.get("video_id") or q.get("table"):
+        return False
+    date_from, date_to = q.get("from", ""), q.get("to", "")
+    return (not date_from or date_from <= day) and (not date_to or day < date_to[:10] or date_to == day)
+
+
+def aggregate_logs(q):
+    """Counts per video, per table and per hour for the filtered entries.
+
+    Days fully inside the query take their counts from the index; the rest
+    of the day shards in range are downloaded SHARD_READERS at a time.
+    """
+    date_from, date_to = q.get("from", "")[:10], q.get("to", "")[:10]
+    index = read_index()
+    totals = empty_counts()
+    fetch = []
+    for day in index["days"]:
+        if (date_from and day < date_from) or (date_to and day > date_to):
+            continue
+        if day in index["counts"] and whole_day(day, q):
+            merge_counts(totals, index["counts"][day])
+        else:
+            fetch.append(day)
+
+    shards = list(_shard_pool.map(_trace.wrap(lambda day: _blob.read_json(shard_path(day), [])), fetch))
+    # Legacy entries are older than every shard (as in iter_logs)
+    legacy = [] if date_from and any(day < date_from for day in index["days"]) else read_logs()
+    for entry in [e for shard in shards for e in shard] + legacy:
+        if matches(entry, q):
+            count_entry(totals, entry)
+    return {
+        "total": totals["total"],
+        "byVideo": dict(sorted(totals["byVideo"].items(), key=lambda kv: -kv[1])),
+        "byTable": dict(sorted(totals["byTable"].items(), key=lambda kv: (len(kv[0]), kv[0]))),
+        "byHour": dict(sorted(totals["byHour"].items())),
+    }
+
+
+def recent_logs(limit=MAX_LOGS):
+    logs = []
+    for _, entry in iter_logs():
+        if len(logs) == limit:
+            break
+        logs.append(entry)
+    return logs
 
 
 class handler(BaseHTTPRequestHandler):
@@ -113,51 +236,49 @@ class handler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         """Save a performance log entry."""
+        _trace.begin(self, "log")
         try:
-            if not BLOB_TOKEN:
+            if not _blob.configured():
                 self.send_json(500, {"error": "BLOB_READ_WRITE_TOKEN no configurado"})
                 return
 
             length = int(self.headers.get("Content-Length", 0))
             body = json.loads(self.rfile.read(length)) if length else {}
 
-            entry = {
-                "video_name": body.get("video_name", ""),
-                "video_id": body.get("video_id", ""),
-                "table_names": body.get("table_names", ""),
-                "table_ids": body.get("table_ids", ""),
-                "table_count": body.get("table_count", 0),
-                "role": body.get("role", ""),
-                "activated_at_madrid": madrid_now()
-            }
-
-            # Read existing, prepend new entry, trim to MAX_LOGS
-            logs = read_logs()
-            logs.insert(0, entry)
-            logs = logs[:MAX_LOGS]
-
-            write_logs(logs)
+            append_log(make_entry(body))
             self.send_json(200, {"success": True})
 
         except Exception as e:
             self.send_json(500, {"success": False, "error": str(e)})
 
     def do_GET(self):
-        """Get recent performance logs."""
+        """Get performance logs.
+
+        No parameters: the newest MAX_LOGS entries as a plain array.
+        ?limit=&cursor= and filters (role, video_id, table, from, to): one page.
+        ?aggregate=1 with the same filters: counts per video, table and hour.
+        """
+        _trace.begin(self, "log")
         try:
-            if not BLOB_TOKEN:
-                self.send_json(200, [])
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            q = {k: v[0] for k, v in query.items() if v}
+
+            if not _blob.configured():
+                if q.get("aggregate"):
+                    self.send_json(200, {"total": 0, "byVideo": {}, "byTable": {}, "byHour": {}})
+                else:
+                    self.send_json(200, {"entries": [], "nextCursor": None} if q else [])
                 return
 
-            logs = read_logs()
-            self.send_json(200, logs)
+            if q.get("aggregate"):
+                self.send_json(200, aggregate_logs(q))
+            elif q:
+                self.send_json(200, query_logs(q))
+            else:
+                self.send_json(200, recent_logs())
 
         except Exception as e:
             self.send_json(500, {"error": str(e)})
 
     def send_json(self, code, data):
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        self.wfile.write(json.dumps(data, ensure_ascii=False).encode())
+        _trace.send_json(self, code, data, blob_cache=True, ensure_ascii=False)
@@ -1,11 +1,16 @@
 from http.server import BaseHTTPRequestHandler
-import json, os, ssl, urllib.request
+import json, os, sys, time, urllib.parse
 
-EMAIL = os.environ.get("DOTYK_EMAIL", "")
-PASSWORD = os.environ.get("DOTYK_PASSWORD", "")
-TOKEN_API = "https://dotyk.me/api/v1.2/token/password"
-RESTAURANT_API = "https://eu.restaurant.dotyk.cloud"
-VENUE = "nua-barcelona"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _blob, _dotyk, _net, _timeline, _trace
+
+EMAIL = _dotyk.EMAIL
+PASSWORD = _dotyk.PASSWORD
+RESTAURANT_API = _dotyk.RESTAURANT_API
+VENUE = _dotyk.VENUE
+
+PARENT_CATEGORY_ID = "7037dd01-8e70-4571-8857-6295f01c8862"
+SCHEDULE_PATH = "schedule.json"
 
 # Fallback names in case frontend doesn't send them
 CATEGORY_NAMES = {
@@ -17,39 +22,77 @@ CATEGORY_NAMES = {
     "4c394f20-e562-4ed5-aa2b-fa7a3ffbbc18": "Smart Menú: Business Edition",
 }
 
-def ssl_ctx():
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    return ctx
-
 def get_restaurant_token():
-    """Pide token directamente a dotyk.me con audience del restaurante"""
-    req = urllib.request.Request(
-        TOKEN_API,
-        data=json.dumps({
-            "username": EMAIL,
-            "password": PASSWORD,
-            "duration": "Long",
-            "audience": f"{RESTAURANT_API}/",
-            "scope": ["caud", "basic"]
-        }).encode(),
-        headers={"Content-Type": "application/json", "User-Agent": "Mozilla/5.0"},
-        method="POST"
-    )
-    with urllib.request.urlopen(req, context=ssl_ctx(), timeout=15) as r:
-        token_data = json.loads(r.read().decode())
-        return token_data.get("token") or token_data.get("access_token")
+    """Token con audience del restaurante (cacheado entre invocaciones)"""
+    return _dotyk.get_restaurant_token()
+
+def menu_snapshot(max_age=_dotyk.CATEGORY_TTL):
+    """Real state of the CATEGORY_NAMES categories, from one cached GET to Dotyk."""
+    items, fetched_at = _dotyk.get_categories(max_age)
+    categories = []
+    for cid, name in CATEGORY_NAMES.items():
+        item = items.get(cid) or {}
+        categories.append({"categoryId": cid, "name": item.get("name") or name,
+                           "isEnabled": item.get("isEnabled"), "known": cid in items})
+    return {"categories": categories, "fetchedAt": fetched_at, "age": round(time.time() - fetched_at, 1)}
+
+def remember_category_state(results):
+    """Record manual toggles in the cron state so the cron's diff sees them."""
+    if not _blob.configured():
+        return
+    try:
+        schedule = _blob.read_json(SCHEDULE_PATH)
+        if not schedule:
+            return
+        basis = _timeline.state_basis(schedule)
+
+        def apply(current):
+            if current.get("enabledAt") != basis["enabledAt"]:
+                # State from before scheduling was switched: start over like the cron would
+                current = dict(current, enabledAt=basis["enabledAt"], lastAction=None, categoryState={})
+            known = dict(current.get("categoryState") or {})
+            for r in results:
+                if r["success"]:
+                    known[r["categoryId"]] = r["isEnabled"]
+                else:
+                    known.pop(r["categoryId"], None)
+            # A manual toggle overrides a retry the cron still has queued for that category
+            toggled = {r["categoryId"] for r in results if r["success"]}
+            pending = {cid: op for cid, op in (current.get("pendingOps") or {}).items() if cid not in toggled}
+            return dict(current, categoryState=known, pendingOps=pending)
+
+        # No cron_state.json yet: start from the state still stored in schedule.json
+        default = _timeline.cron_view(schedule, None)
+        default = dict({k: default[k] for k in _timeline.STATE_KEYS}, **basis)
+        _blob.update_json(_timeline.STATE_PATH, apply, default=default)
+    except Exception:
+        pass  # best effort: the cron re-patches unknown categories anyway
 
 class handler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         self.end_headers()
 
+    def do_GET(self):
+        """Estado real de las categorias (?fresh=1 ignora la cache de CATEGORY_TTL s)."""
+        _trace.begin(self, "menus")
+        try:
+            if not EMAIL or not PASSWORD:
+                self.send_json(500, {"success": False, "error": "Sin credenciales"})
+                return
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            fresh = query.get("fresh", [""])[0] == "1"
+            self.send_json(200, dict(menu_snapshot(0 if fresh else _dotyk.CATEGORY_TTL), success=True))
+        except _net.HTTPError as he:
+            self.send_json(502, {"success": False, "error": f"GET {he.code}: {he.body.decode(errors='replace')[:300]}"})
+        except Exception as e:
+            self.send_json(500, {"success": False, "error": str(e)})
+
     def do_POST(self):
+        _trace.begin(self, "menus")
         try:
             length = int(self.headers.get('Content-Length', 0))
             body = json.loads(self.rfile.read(length)) if length else {}
@@ -57,6 +100,21 @@ class handler(BaseHTTPRequestHandler):
             is_enabled = body.get("isEnabled")
             category_name = body.get("name") or CATEGORY_NAMES.get(category_id, "")
 
+            # Lote: {"operations": [{categoryId, isEnabled, name?}, ...]}, validado antes de pedir token
+            ops = None
+            if "operations" in body:
+                ops = []
+                for op in body.get("operations") or []:
+                    cid = op.get("categoryId") if isinstance(op, dict) else None
+                    if not isinstance(cid, str) or not cid or not isinstance(op.get("isEnabled"), bool):
+                        self.send_json(400, {"success": False, "error": "Cada operacion necesita categoryId (texto) e isEnabled (true/false)"})
+                        return
+                    ops.append({"categoryId": cid, "isEnabled": op["isEnabled"],
+                                "name": op.get("name") or CATEGORY_NAMES.get(cid, "")})
+                if not ops:
+                    self.send_json(400, {"success": False, "error": "Sin operaciones"})
+                    return
+
             if not EMAIL or not PASSWORD:
                 self.send_json(500, {"success": False, "error": f"Sin credenciales. EMAIL={bool(EMAIL)} PASS={bool(PASSWORD)}"})
                 return
@@ -71,38 +129,36 @@ class handler(BaseHTTPRequestHandler):
                 self.send_json(500, {"success": False, "error": f"Token: {str(e)}"})
                 return
 
+            # Lote -> un token, PATCHes en paralelo
+            # (el padre se activa antes que los hijos y se desactiva despues)
+            if ops is not None:
+                parent = [op for op in ops if op["categoryId"] == PARENT_CATEGORY_ID]
+                children = [op for op in ops if op["categoryId"] != PARENT_CATEGORY_ID]
+                results = _dotyk.patch_with_parent(parent[0] if parent else None, children)
+                remember_category_state(results)
+                failed = [r for r in results if not r["success"]]
+                resp = {"success": not failed, "results": results}
+                if failed:
+                    resp["error"] = f"{failed[0]['name']}: {failed[0]['error']}"
+                self.send_json(200 if not failed else 500, resp)
+                return
+
             # Paso 2: PATCH a la categoria
-            url = f"{RESTAURANT_API}/{VENUE}/Category"
             payload = {"id": category_id, "name": category_name, "isEnabled": is_enabled, "type": "Category"}
-            req = urllib.request.Request(
-                url,
-                data=json.dumps(payload).encode(),
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {jwt_token}",
-                    "User-Agent": "Mozilla/5.0"
-                },
-                method="PATCH"
-            )
-
             try:
-                with urllib.request.urlopen(req, context=ssl_ctx(), timeout=15) as resp:
-                    resp_body = resp.read().decode()[:300]
-                    self.send_json(200, {"success": True, "message": "OK", "debug": {"sent": payload, "resp": resp_body}})
-            except urllib.request.HTTPError as he:
-                body_err = ""
-                try:
-                    body_err = he.read().decode()[:300]
-                except:
-                    pass
+                # Token cacheado: si dotyk lo rechaza (401) se pide uno nuevo y se reintenta
+                _, resp_body = _dotyk.with_token(
+                    _dotyk.RESTAURANT_AUDIENCE, ["caud", "basic"],
+                    lambda token: _dotyk.patch_category(token, category_id, category_name, is_enabled)
+                )
+                remember_category_state([{"categoryId": category_id, "isEnabled": is_enabled, "success": True}])
+                self.send_json(200, {"success": True, "message": "OK", "debug": {"sent": payload, "resp": resp_body[:300]}})
+            except _net.HTTPError as he:
+                body_err = he.body.decode(errors="replace")[:300]
                 self.send_json(500, {"success": False, "error": f"PATCH {he.code}: {body_err}", "debug": {"sent": payload}})
 
         except Exception as e:
             self.send_json(500, {"success": False, "error": f"General: {str(e)}"})
 
     def send_json(self, code, data):
-        self.send_response(code)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        _trace.send_json(self, code, data)
@@ -0,0 +1,43 @@
+from http.server import BaseHTTPRequestHandler
+import os, sys, urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _metrics, _net, _trace
+
+MAX_WINDOW = _metrics.RETENTION
+
+
+class handler(BaseHTTPRequestHandler):
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.end_headers()
+
+    def do_GET(self):
+        """Counters and latency per upstream and per handler.
+
+        ?window=<seconds> (default 3600, at most 24 h) limits the histograms
+        to the most recent slots. ?flush=1 first writes this instance's
+        unflushed part to the Blob store. "breakers" is this instance's
+        circuit breaker state and adaptive timeout per host.
+        """
+        _trace.begin(self, "metrics")
+        try:
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            q = {k: v[0] for k, v in query.items() if v}
+            try:
+                window = max(_metrics.SLOT, min(MAX_WINDOW, int(q.get("window", 3600))))
+            except ValueError:
+                self.send_json(400, {"error": "window debe ser un número de segundos"})
+                return
+            if q.get("flush") == "1":
+                _metrics.flush()
+            # Breakers are per instance: what this one currently sees
+            self.send_json(200, dict(_metrics.report(window), breakers=_net.breaker_state()))
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+
+    def send_json(self, code, data):
+        _trace.send_json(self, code, data, ensure_ascii=False, extra={"Cache-Control": "no-store"})
@@ -1,27 +1,124 @@
 from http.server import BaseHTTPRequestHandler
-import json, os, ssl, urllib.request, http.cookiejar
+import json, os, sys, time, urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
-EMAIL = os.environ.get("DOTYK_EMAIL", "")
-PASSWORD = os.environ.get("DOTYK_PASSWORD", "")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _blob, _dotyk, _jobs, _net, _singleflight, _trace, log
+
+EMAIL = _dotyk.EMAIL
+PASSWORD = _dotyk.PASSWORD
 VIDEO_URL = "https://irtperformanceshoweu.blob.core.windows.net/dotykcloudperformanceshow/1qfl_FzhVSQfWSsQ6uBLxswJV9x4_BbeV22KojBIMOwxJAD4CGPWPwFnFf8m"
-TOKEN_API = "https://dotyk.me/api/v1.2/token/password"
-LOGIN_API = "https://dotyk.tech/api/user/LoginWithDotykMe"
-START_API = "https://dotyk.tech/api/PerformanceShow/start/"
+START_API = os.environ.get("DOTYK_START_API", "https://dotyk.tech/api/PerformanceShow/start/")
+MAX_JOBS = 20
+START_WORKERS = 6  # concurrent starts of a batch
+
+_executor = ThreadPoolExecutor(max_workers=START_WORKERS, thread_name_prefix="publish-start")
+
+def parse_tables(tables_data):
+    # El frontend envía un objeto con "tables" que es una lista de objetos { item: { tableId: "..." } }
+    # O directamente una lista de IDs si es POST simple
+    table_ids = []
+    for item in tables_data or []:
+        if isinstance(item, dict) and "item" in item:
+            table_ids.append(item["item"]["tableId"])
+        else:
+            table_ids.append(str(item))
+    return table_ids
+
+def start_show(cookie, table_ids, video_url):
+    params = "&".join([f"id={t}" for t in table_ids])
+    url = f"{START_API}?viewMode=FullScreen&{params}"
+    with _trace.phase("start"):
+        _net.request("POST", url, json_body={"ApplicationName": "Dotyk.Extension.PerformanceShow", "Argument": f"-performaceUrl {video_url}", "StartOptions": {"IsForceFullScreenIfSupported": True}}, headers={"Cookie": cookie, "X-Requested-With": "XMLHttpRequest"}, timeout=30)
+
+def start_with_session(table_ids, video_url):
+    """start_show on the cached session; an expired session is renewed transparently.
+    The same video on the same tables twice within a few seconds starts once."""
+    _singleflight.do("start", ",".join(sorted(table_ids)), video_url,
+                     lambda: _dotyk.with_tech_session(lambda cookie: start_show(cookie, table_ids, video_url)))
+
+def start_jobs(jobs):
+    """Run several PerformanceShow starts concurrently on one login session.
+
+    jobs: list of {"videoUrl", "tableIds"}. Returns per-job status and timing, in order.
+    """
+
+    def run(job):
+        started = time.monotonic()
+        result = {"videoUrl": job["videoUrl"], "tables": job["tableIds"]}
+        try:
+            start_with_session(job["tableIds"], job["videoUrl"])
+            result.update(success=True)
+        except _net.HTTPError as e:
+            result.update(success=False, status=e.code, error=f"start {e.code}: {e.body.decode(errors='replace')[:300]}")
+        except Exception as e:
+            result.update(success=False, error=str(e))
+        result["ms"] = round((time.monotonic() - started) * 1000)
+        return result
+
+    return list(_executor.map(_trace.wrap(run), jobs))
+
+def retryable(part):
+    """Timeouts, connection errors and 5xx/408/429 are worth another attempt; other 4xx aren't."""
+    status = part.get("status")
+    return status is None or status >= 500 or status in (408, 429)
+
+def run_publish(job):
+    """_jobs runner: starts the parts not confirmed yet (a retry doesn't
+    replay tables that already got the video) and, once all are, writes the
+    activation log entry."""
+    parts = job.get("parts") or [dict(p, success=False) for p in job["payload"]["parts"]]
+    pending = [p for p in parts if not p["success"]]
+    for part, result in zip(pending, start_jobs(pending)):
+        part.update(success=result["success"], status=result.get("status"), error=result.get("error"), ms=result["ms"])
+    failed = [p for p in parts if not p["success"]]
+    if failed:
+        return False, {"parts": parts}, failed[0]["error"], all(retryable(p) for p in failed)
+
+    logged = None
+    entry = job["payload"].get("log")
+    if entry and _blob.configured():
+        try:
+            log.append_log(log.make_entry(entry))
+            logged = True
+        except Exception:
+            logged = False  # the show is running; don't retry the starts over the log
+    return True, {"parts": parts, "logged": logged}, None, False
+
+RUNNERS = {"publish": run_publish}
 
-def ssl_ctx():
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    return ctx
+def run_jobs(job_id=None):
+    """Run the due publish jobs (all, or just job_id). Returns the settled jobs."""
+    return _jobs.run(RUNNERS, job_id)
 
 class handler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, PATCH, OPTIONS')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, PATCH, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         self.end_headers()
 
+    def do_GET(self):
+        """GET /api/publish/status?id=<job>: one job; without id, the latest ones."""
+        _trace.begin(self, "publish")
+        try:
+            url = urllib.parse.urlparse(self.path)
+            if url.path.rstrip('/') != '/api/publish/status':
+                self.send_json(404, {"error": "No encontrado"})
+                return
+            job_id = urllib.parse.parse_qs(url.query).get('id', [''])[0]
+            if not job_id:
+                self.send_json(200, {"jobs": [_jobs.public(j) for j in _jobs.recent()]})
+                return
+            job = _jobs.get(job_id)
+            if job is None:
+                self.send_json(404, {"error": "Trabajo no encontrado"})
+                return
+            self.send_json(200, _jobs.public(job))
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+
     def do_POST(self):
         self._handle_request()
 
@@ -29,54 +126,60 @@ class handler(BaseHTTPRequestHandler):
         self._handle_request()
 
     def _handle_request(self):
+        _trace.begin(self, "publish")
         try:
+            url = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(url.query)
             length = int(self.headers.get('Content-Length', 0))
             body = json.loads(self.rfile.read(length)) if length else {}
-            
-            # El frontend envía un objeto con "tables" que es una lista de objetos { item: { tableId: "..." } }
-            # O directamente una lista de IDs si es POST simple
-            tables_data = body.get("tables", [])
-            table_ids = []
-            
-            for item in tables_data:
-                if isinstance(item, dict) and "item" in item:
-                    table_ids.append(item["item"]["tableId"])
-                else:
-                    table_ids.append(str(item))
-                    
-            video_url = body.get("videoUrl") or VIDEO_URL
-            
-            if not table_ids:
-                self.send_json(400, {"error": "No hay mesas seleccionadas"})
+
+            # Worker: ejecuta los trabajos pendientes (la página lo llama justo después de encolar)
+            if url.path.rstrip('/') == '/api/publish/run':
+                job_id = query.get('id', [''])[0] or None
+                self.send_json(200, {"jobs": [_jobs.public(j) for j in run_jobs(job_id)]})
                 return
+
+            # Lote: {"jobs": [{videoUrl, tables}, ...]} -> un login, starts en paralelo
+            if "jobs" in body:
+                parts = [{"videoUrl": j.get("videoUrl") or VIDEO_URL, "tableIds": parse_tables(j.get("tables"))}
+                         for j in body.get("jobs") or []]
+                if not parts or any(not p["tableIds"] for p in parts):
+                    self.send_json(400, {"error": "Cada trabajo necesita mesas"})
+                    return
+                if len(parts) > MAX_JOBS:
+                    self.send_json(400, {"error": f"Maximo {MAX_JOBS} trabajos por lote"})
+                    return
+            else:
+                parts = [{"videoUrl": body.get("videoUrl") or VIDEO_URL, "tableIds": parse_tables(body.get("tables", []))}]
+                if not parts[0]["tableIds"]:
+                    self.send_json(400, {"error": "No hay mesas seleccionadas"})
+                    return
             if not EMAIL or not PASSWORD:
                 self.send_json(500, {"error": "Credenciales no configuradas en entorno"})
                 return
-            
-            # Token
-            req = urllib.request.Request(TOKEN_API, data=json.dumps({"username": EMAIL, "password": PASSWORD, "duration": "Long", "audience": "https://dotyk.tech/", "scope": ["basic"]}).encode(), headers={"Content-Type": "application/json"}, method="POST")
-            with urllib.request.urlopen(req, context=ssl_ctx(), timeout=30) as r:
-                token_data = json.loads(r.read().decode())
-                token = token_data.get("token") or token_data.get("access_token")
-            
-            # Login + Publish
-            cj = http.cookiejar.CookieJar()
-            opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cj), urllib.request.HTTPSHandler(context=ssl_ctx()))
-            req = urllib.request.Request(LOGIN_API, data=f'"{token}"'.encode(), headers={"Content-Type": "application/json"}, method="POST")
-            opener.open(req, timeout=30)
-            
-            params = "&".join([f"id={t}" for t in table_ids])
-            url = f"{START_API}?viewMode=FullScreen&{params}"
-            req = urllib.request.Request(url, data=json.dumps({"ApplicationName": "Dotyk.Extension.PerformanceShow", "Argument": f"-performaceUrl {video_url}", "StartOptions": {"IsForceFullScreenIfSupported": True}}).encode(), headers={"Content-Type": "application/json", "X-Requested-With": "XMLHttpRequest"}, method="POST")
-            opener.open(req, timeout=30)
-            
-            self.send_json(200, {"success": True, "status": "ok", "message": f"Publicado en {len(table_ids)} mesa(s)"})
+            if not _blob.configured():
+                self.send_json(500, {"error": "BLOB_READ_WRITE_TOKEN no configurado (cola de publicacion)"})
+                return
+
+            # Se encola y se responde ya; el log de activacion lo escribe el worker al confirmar
+            job = _jobs.enqueue("publish", {"parts": parts, "log": body.get("log")})
+
+            # ?wait=1: ejecutarlo en esta misma peticion y devolver el resultado (scripts, bench)
+            if query.get('wait', [''])[0] == '1':
+                settled = {j["id"]: j for j in run_jobs(job["id"])}.get(job["id"]) or _jobs.get(job["id"])
+                code = {"done": 200, "failed": 500}.get(settled["status"], 202)
+                self.send_json(code, dict(_jobs.public(settled), success=settled["status"] == "done", jobId=job["id"]))
+                return
+
+            self.send_json(202, {
+                "success": True,
+                "jobId": job["id"],
+                "status": job["status"],
+                "statusUrl": f"/api/publish/status?id={job['id']}",
+                "message": f"Publicacion en cola ({sum(len(p['tableIds']) for p in parts)} mesa(s))"
+            })
         except Exception as e:
             self.send_json(500, {"success": False, "error": str(e)})
 
     def send_json(self, code, data):
-        self.send_response(code)
-        self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        _trace.send_json(self, code, data)
@@ -1,83 +1,54 @@
 from http.server import BaseHTTPRequestHandler
-import json, os, ssl, urllib.request, urllib.parse
+import json, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _blob, _timeline, _trace
 
-BLOB_TOKEN = os.environ.get("BLOB_READ_WRITE_TOKEN", "")
 SCHEDULE_PATH = "schedule.json"
 ADMIN_PIN = "9069"
 
-BLOB_API = "https://blob.vercel-storage.com"
-
-def ssl_ctx():
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    return ctx
-
-def get_store_id():
-    """Extract store ID from token: vercel_blob_rw_STOREID_..."""
-    parts = BLOB_TOKEN.split("_")
-    if len(parts) >= 4:
-        return parts[3]
-    return None
+# Menus used by rules without menuIds (same as cron.py)
+DEFAULT_MENU_IDS = [
+    "7b2ed65e-05c9-45b9-b7b9-adc83345cd5b",  # Poke edition
+    "a61bbcb4-6efe-4be7-85f1-2d6c84adf564",  # Burger edition
+    "782e61b7-9cc9-48e2-b5be-b78876692929",   # Crea tu Smart Menú
+]
 
 def read_schedule():
-    """Read schedule from Vercel Blob. Returns default if not found."""
+    """Read schedule from Vercel Blob, with the cron state (cron_state.json) merged in."""
     default = {"enabled": False, "rules": [], "lastAction": None, "lastCronRun": None}
-    if not BLOB_TOKEN:
-        return default
-
-    # Method 1: Try direct URL from store ID
-    store_id = get_store_id()
-    if store_id:
+    return _timeline.cron_view(_blob.read_json(SCHEDULE_PATH, default), _blob.read_json(_timeline.STATE_PATH, None))
+
+def migrate_state(legacy):
+    """First save after the split: move the cron state still stored in
+    schedule.json to cron_state.json so it isn't lost."""
+    if legacy.get("lastCronRun") and _blob.read_json(_timeline.STATE_PATH, None, max_age=0) is None:
+        state = {k: legacy.get(k) for k in _timeline.STATE_KEYS}
+        state.update(_timeline.state_basis(legacy))
         try:
-            url = f"https://{store_id}.public.blob.vercel-storage.com/{SCHEDULE_PATH}"
-            req = urllib.request.Request(url)
-            with urllib.request.urlopen(req, context=ssl_ctx(), timeout=10) as r:
-                return json.loads(r.read().decode())
-        except urllib.error.HTTPError as e:
-            if e.code == 404:
-                return default
-        except:
-            pass
-
-    # Method 2: Use list API to find blob URL
-    try:
-        req = urllib.request.Request(
-            f"{BLOB_API}?prefix={SCHEDULE_PATH}",
-            headers={"Authorization": f"Bearer {BLOB_TOKEN}"},
-            method="GET"
-        )
-        with urllib.request.urlopen(req, context=ssl_ctx(), timeout=10) as r:
-            data = json.loads(r.read().decode())
-            blobs = data.get("blobs", [])
-            if blobs:
-                blob_file_url = blobs[0].get("url", "")
-                if blob_file_url:
-                    req2 = urllib.request.Request(blob_file_url)
-                    with urllib.request.urlopen(req2, context=ssl_ctx(), timeout=10) as r2:
-                        return json.loads(r2.read().decode())
-    except:
-        pass
-
-    return default
-
-def write_schedule(schedule_data):
-    """Write schedule JSON to Vercel Blob."""
-    body = json.dumps(schedule_data, ensure_ascii=False).encode("utf-8")
-    req = urllib.request.Request(
-        f"{BLOB_API}/{SCHEDULE_PATH}",
-        data=body,
-        headers={
-            "Authorization": f"Bearer {BLOB_TOKEN}",
-            "Content-Type": "application/json",
-            "x-api-version": "7",
-            "x-content-type": "application/json",
-            "x-add-random-suffix": "0",
-        },
-        method="PUT"
-    )
-    with urllib.request.urlopen(req, context=ssl_ctx(), timeout=10) as r:
-        return json.loads(r.read().decode())
+            _blob.write_json(_timeline.STATE_PATH, state, if_absent=True)
+        except _blob.PreconditionFailed:
+            pass  # the cron got there first
+
+def write_schedule(new_schedule):
+    """Write the admin part of the schedule (rules, enabled) to Vercel Blob.
+
+    Versioned write: if another save lands in between, the new rules are
+    re-applied on top of it. Returns (saved schedule, write result).
+    """
+    def apply(current):
+        migrate_state(current)
+        schedule = {k: v for k, v in new_schedule.items() if k not in _timeline.STATE_KEYS}
+        # Switching scheduling on/off invalidates what the cron knows (menus may have been toggled by hand)
+        if schedule["enabled"] != bool(current.get("enabled")):
+            schedule["enabledAt"] = _timeline.madrid_now().isoformat(timespec="seconds")
+        else:
+            schedule["enabledAt"] = current.get("enabledAt")
+        # Compiled weekly timeline stored alongside the rules, so the cron never recompiles
+        schedule["compiled"] = _timeline.compile_rules(schedule["rules"], DEFAULT_MENU_IDS)
+        return schedule
+    default = {"enabled": False, "rules": []}
+    return _blob.update_json(SCHEDULE_PATH, apply, default=default)
 
 
 class handler(BaseHTTPRequestHandler):
@@ -90,8 +61,9 @@ class handler(BaseHTTPRequestHandler):
 
     def do_GET(self):
         """Return current schedule"""
+        _trace.begin(self, "schedule")
         try:
-            if not BLOB_TOKEN:
+            if not _blob.configured():
                 self.send_json(200, {"enabled": False, "rules": [], "lastAction": None, "lastCronRun": None, "_note": "BLOB_TOKEN not configured"})
                 return
             schedule = read_schedule()
@@ -101,6 +73,7 @@ class handler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         """Save schedule (admin only)"""
+        _trace.begin(self, "schedule")
         try:
             length = int(self.headers.get("Content-Length", 0))
             body = json.loads(self.rfile.read(length)) if length else {}
@@ -110,7 +83,7 @@ class handler(BaseHTTPRequestHandler):
                 self.send_json(403, {"error": "PIN incorrecto"})
                 return
 
-            if not BLOB_TOKEN:
+            if not _blob.configured():
                 self.send_json(500, {"error": "BLOB_READ_WRITE_TOKEN no configurado en Vercel"})
                 return
 
@@ -120,31 +93,21 @@ class handler(BaseHTTPRequestHandler):
             if "enabled" not in new_schedule:
                 new_schedule["enabled"] = False
 
-            # Preserve lastAction and lastCronRun from current server state
-            # so that admin saves don't overwrite cron state
-            current = read_schedule()
-            new_schedule["lastAction"] = current.get("lastAction")
-            new_schedule["lastCronRun"] = current.get("lastCronRun")
+            new_schedule["enabled"] = bool(new_schedule["enabled"])
 
-            # If enabled state changed, reset lastAction so cron re-evaluates
-            if new_schedule.get("enabled") != current.get("enabled"):
-                new_schedule["lastAction"] = None
+            # lastAction/lastCronRun/categoryState live in cron_state.json (owned by the cron),
+            # so the admin save only writes rules + enabled and never clobbers cron state.
+            # The cron drops its lastAction when the rules or enabledAt it was applied to change.
+            _, result = write_schedule(new_schedule)
 
-            # If rules changed, reset lastAction so cron re-evaluates
-            current_rules = json.dumps(current.get("rules", []), sort_keys=True)
-            new_rules = json.dumps(new_schedule.get("rules", []), sort_keys=True)
-            if current_rules != new_rules:
-                new_schedule["lastAction"] = None
-
-            result = write_schedule(new_schedule)
-            schedule = new_schedule
+            # Next transition, so the cron can skip ticks without loading schedule.json
+            schedule = read_schedule()
+            marker = _timeline.build_marker(schedule, _timeline.madrid_now(), DEFAULT_MENU_IDS)
+            # jobsDue belongs to the publish queue (_jobs.py): keep it
+            _blob.update_json(_timeline.MARKER_PATH, lambda m: dict(marker, jobsDue=(m or {}).get("jobsDue")), default={})
             self.send_json(200, {"success": True, "url": result.get("url", ""), "schedule": schedule})
         except Exception as e:
             self.send_json(500, {"error": f"Write: {str(e)}"})
 
     def send_json(self, code, data):
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        self.wfile.write(json.dumps(data, ensure_ascii=False).encode())
+        _trace.send_json(self, code, data, blob_cache=True, ensure_ascii=False)
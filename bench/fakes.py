@@ -0,0 +1,181 @@
+"""Local stand-ins for the upstreams the api/* handlers talk to.
+
+One HTTP server plays all of them, each under its own prefix:
+
+    POST  /token/                      dotyk.me password grant (JWT with exp)
+    POST  /login/                      dotyk.tech LoginWithDotykMe (Set-Cookie)
+    POST  /start/                      dotyk.tech PerformanceShow/start (needs the cookie)
+    PATCH /restaurant/<venue>/Category eu.restaurant.dotyk.cloud
+    GET   /restaurant/<venue>/Category
+    PUT   /blob/<path>                 Vercel Blob put (x-if-match, x-allow-overwrite)
+    GET   /blob/?prefix=               Vercel Blob list
+    GET   /public/<path>               public blob URL (ETag, If-None-Match)
+
+Every route sleeps latency +- jitter seconds and fails with error_status at
+error_rate, so retries, caches and fan-out can be measured offline.
+"""
+import base64, contextlib, hashlib, json, random, threading, time, urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_jwt(ttl=7200):
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": int(time.time()) + ttl}).encode()).decode().rstrip("=")
+    return f"bench.{payload}.sig"
+
+
+class Upstreams:
+    """Fake Dotyk + Blob server. env() gives the variables that point api/* at it."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.counting = True
+        self.blobs = {}  # path -> (etag, bytes)
+        self.categories = {}  # id -> isEnabled
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def env(self):
+        return {
+            "DOTYK_TOKEN_API": f"{self.url}/token/",
+            "DOTYK_LOGIN_API": f"{self.url}/login/",
+            "DOTYK_START_API": f"{self.url}/start/",
+            "DOTYK_RESTAURANT_API": f"{self.url}/restaurant",
+            "BLOB_API_URL": f"{self.url}/blob",
+            "BLOB_PUBLIC_URL": f"{self.url}/public",
+        }
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls.clear()
+
+    @contextlib.contextmanager
+    def uncounted(self):
+        """Calls made inside (test setup) are left out of counts()."""
+        self.counting = False
+        try:
+            yield
+        finally:
+            self.counting = True
+
+    def counts(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real hosts
+            disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body=b"", headers=None):
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_any(self):
+                url = urllib.parse.urlsplit(self.path)
+                route = url.path.strip("/").split("/")[0]
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                with fake.lock:
+                    if fake.counting:
+                        fake.calls[f"{self.command} {route}"] += 1
+                    fail = fake.random.random() < fake.error_rate
+                    delay = max(0.0, fake.latency + fake.random.uniform(-fake.jitter, fake.jitter))
+                time.sleep(delay)
+                if fail:
+                    self.reply(fake.error_status, {"error": "injected"})
+                    return
+                getattr(self, "route_" + route, self.route_missing)(url, body)
+
+            do_GET = do_POST = do_PUT = do_PATCH = handle_any
+
+            def route_missing(self, url, body):
+                self.reply(404, {"error": "not found"})
+
+            def route_token(self, url, body):
+                self.reply(200, {"token": fake_jwt()}, {"Content-Type": "application/json"})
+
+            def route_login(self, url, body):
+                session = hashlib.sha1(body).hexdigest()[:16]
+                self.reply(200, b"", {"Set-Cookie": f".AspNetCore.Session={session}; Path=/; Max-Age=3600"})
+
+            def route_start(self, url, body):
+                if "AspNetCore.Session=" not in self.headers.get("Cookie", ""):
+                    self.reply(401, {"error": "no session"})
+                    return
+                self.reply(200, {"ok": True}, {"Content-Type": "application/json"})
+
+            def route_restaurant(self, url, body):
+                if self.command == "PATCH":
+                    data = json.loads(body or b"{}")
+                    with fake.lock:
+                        fake.categories[data.get("id")] = data.get("isEnabled")
+                    self.reply(200, data, {"Content-Type": "application/json"})
+                    return
+                with fake.lock:
+                    items = [{"id": cid, "isEnabled": on, "type": "Category"} for cid, on in fake.categories.items()]
+                self.reply(200, items, {"Content-Type": "application/json"})
+
+            def route_blob(self, url, body):
+                path = url.path[len("/blob/"):]
+                if self.command == "GET":
+                    prefix = urllib.parse.parse_qs(url.query).get("prefix", [""])[0]
+                    with fake.lock:
+                        blobs = [{"pathname": p, "url": f"{fake.url}/public/{p}"} for p in fake.blobs if p.startswith(prefix)]
+                    self.reply(200, {"blobs": blobs}, {"Content-Type": "application/json"})
+                    return
+                with fake.lock:
+                    current = fake.blobs.get(path)
+                    if_match = self.headers.get("x-if-match")
+                    if if_match is not None and (current is None or current[0] != if_match):
+                        status = 412
+                    elif self.headers.get("x-allow-overwrite") == "0" and current is not None:
+                        status = 409
+                    else:
+                        status = 200
+                        etag = '"%s"' % hashlib.md5(body + str(time.time_ns()).encode()).hexdigest()
+                        fake.blobs[path] = (etag, body)
+                if status != 200:
+                    self.reply(status, {"error": "precondition"})
+                    return
+                self.reply(200, {"url": f"{fake.url}/public/{path}", "pathname": path, "etag": etag},
+                           {"Content-Type": "application/json"})
+
+            def route_public(self, url, body):
+                path = url.path[len("/public/"):]
+                with fake.lock:
+                    current = fake.blobs.get(path)
+                if current is None:
+                    self.reply(404, {"error": "not found"})
+                elif self.headers.get("If-None-Match") == current[0]:
+                    self.reply(304, b"", {"ETag": current[0]})
+                else:
+                    self.reply(200, current[1], {"ETag": current[0], "Content-Type": "application/json"})
+
+        return Handler
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the api/* handlers.
+
+Starts the fake upstreams (bench/fakes.py), points api/* at them through
+the env vars, serves the handlers with the local server's router and
+drives every endpoint under load. Reports p50/p95/p99 latency, throughput
+and upstream calls per request.
+
+    python bench/run.py                      # all scenarios, defaults
+    python bench/run.py -n 500 -c 16 --latency 80 --error-rate 0.05
+    python bench/run.py --only cron,menus --storage local --json before.json
+"""
+import argparse, json, os, sys, tempfile, threading, time, urllib.error, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+sys.path.insert(0, ROOT)
+
+from fakes import Upstreams
+
+CRON_SECRET = "bench-secret"
+ADMIN_PIN = "9069"
+MENU_IDS = [
+    "7037dd01-8e70-4571-8857-6295f01c8862",
+    "7b2ed65e-05c9-45b9-b7b9-adc83345cd5b",
+    "a61bbcb4-6efe-4be7-85f1-2d6c84adf564",
+    "782e61b7-9cc9-48e2-b5be-b78876692929",
+    "338712fd-f2a9-463e-8532-6fa17c7ebe8e",
+    "4c394f20-e562-4ed5-aa2b-fa7a3ffbbc18",
+]
+ALL_DAY = [{"days": list(range(7)), "startTime": "00:00", "endTime": "23:59", "active": True}]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[k]
+
+
+def force_reconcile(upstreams):
+    """Make the next cron tick take the full path (as after an admin save) and
+    patch every category: Dotyk forgets their state, so neither the live
+    snapshot nor cron_state.json says they are already applied, and the
+    previous tick's PATCH results aren't reused (_singleflight)."""
+    import _blob, _dotyk, _singleflight, _timeline
+    _blob.write_json(_timeline.STATE_PATH, {})
+    _blob.write_json(_timeline.MARKER_PATH, {"dirty": True})
+    with upstreams.lock:
+        upstreams.categories.clear()
+    _dotyk.invalidate_categories()
+    _singleflight.invalidate("patch")
+
+
+def scenarios():
+    """name -> (method, path, body, before each request (gets the Upstreams), run serially)
+
+    body may be a function of the request number. The Dotyk scenarios send a
+    different payload on every request: identical ones would be answered by
+    _singleflight's result cache and the run would measure that, not the handler.
+    """
+    log_entry = {"video_name": "Bench", "video_id": "v1", "table_names": "Mesa 1",
+                 "table_ids": "t1", "table_count": 1, "role": "bench"}
+    return {
+        "schedule-get": ("GET", "/api/schedule", None, None, False),
+        "schedule-save": ("POST", "/api/schedule", {"pin": ADMIN_PIN, "schedule": {"enabled": True, "rules": ALL_DAY}}, None, False),
+        "cron": ("GET", "/api/cron", None, None, False),
+        "cron-apply": ("GET", "/api/cron", None, force_reconcile, True),
+        "menus": ("POST", "/api/menus", lambda n: {"operations": [
+            {"categoryId": cid, "isEnabled": n % 2 == 0, "name": f"Bench {n}"} for cid in MENU_IDS]}, None, False),
+        "publish": ("POST", "/api/publish?wait=1", lambda n: {"tables": [f"t{n}-{i}" for i in range(3)]}, None, False),
+        "publish-enqueue": ("POST", "/api/publish", lambda n: {"tables": [f"t{n}-{i}" for i in range(3)]}, None, False),
+        "publish-batch": ("POST", "/api/publish?wait=1", lambda n: {"jobs": [{"tables": [f"t{n}-{i}"]} for i in range(3)]}, None, False),
+        "log-append": ("POST", "/api/log", log_entry, None, False),
+        "log-page": ("GET", "/api/log?limit=20", None, None, False),
+        "log-aggregate": ("GET", "/api/log?aggregate=1", None, None, False),
+    }
+
+
+def clear_caches():
+    """Forget everything a warm instance would have: tokens, session, blob cache, pooled connections."""
+    import _blob, _dotyk, _net, _timeline
+    _blob.invalidate()
+    _dotyk._tokens.clear()
+    _dotyk._session.clear()
+    _timeline._compiled.clear()
+    with _net._pools_lock:
+        for idle in _net._pools.values():
+            for conn in idle:
+                conn.close()
+        _net._pools.clear()
+
+
+def call(base, method, path, body):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base + path, data=data, method=method, headers={
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {CRON_SECRET}",
+    })
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=120) as resp:
+            resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    return (time.perf_counter() - started) * 1000, status
+
+
+def run_scenario(base, upstreams, name, spec, requests, concurrency, cold):
+    method, path, body, before, serial = spec
+    workers = 1 if (serial or cold) else concurrency
+    payload = body if callable(body) else (lambda n: body)
+    call(base, method, path, payload(-1))  # warm-up, not measured
+    upstreams.reset_counts()
+
+    def one(n):
+        if cold:
+            clear_caches()
+        if before:
+            with upstreams.uncounted():
+                before(upstreams)
+        return call(base, method, path, payload(n))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        samples = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(ms for ms, _ in samples)
+    calls = upstreams.counts()
+    return {
+        "scenario": name,
+        "requests": requests,
+        "concurrency": workers,
+        "errors": sum(1 for _, status in samples if status >= 400),
+        "throughput": round(requests / elapsed, 1),
+        "p50": round(percentile(latencies, 50), 1),
+        "p95": round(percentile(latencies, 95), 1),
+        "p99": round(percentile(latencies, 99), 1),
+        "upstream": {k: round(v / requests, 2) for k, v in sorted(calls.items())},
+    }
+
+
+def print_row(r):
+    upstream = " ".join(f"{k}={v:g}" for k, v in r["upstream"].items()) or "-"
+    print(f"{r['scenario']:<15}{r['requests']:>6}{r['concurrency']:>4}{r['errors']:>5}{r['throughput']:>9}"
+          f"{r['p50']:>9}{r['p95']:>9}{r['p99']:>9}  {upstream}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--requests", type=int, default=100, help="requests per scenario")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=20, help="upstream latency in ms")
+    parser.add_argument("--jitter", type=float, default=5, help="+- ms around --latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls that fail")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--storage", choices=["blob", "local"], default="blob",
+                        help="blob: fake Vercel Blob over HTTP, local: STORAGE_BACKEND=local in a temp dir")
+    parser.add_argument("--cold", action="store_true", help="clear in-process caches before every request (serial)")
+    parser.add_argument("--only", default="", help="comma-separated scenarios: " + ", ".join(scenarios()))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    upstreams = Upstreams(args.latency / 1000, args.jitter / 1000, args.error_rate, args.error_status, args.seed).start()
+
+    # api/* read their configuration at import time
+    os.environ.update(upstreams.env())
+    os.environ.update(DOTYK_EMAIL="bench@example.com", DOTYK_PASSWORD="bench", CRON_SECRET=CRON_SECRET,
+                      BLOB_READ_WRITE_TOKEN="vercel_blob_rw_bench_token")
+    os.environ.setdefault("TRACE_LOG", "0")  # keep the per-request JSON lines out of the report
+    if args.storage == "local":
+        os.environ.update(STORAGE_BACKEND="local", STORAGE_DIR=tempfile.mkdtemp(prefix="bench-storage-"))
+    else:
+        os.environ["STORAGE_BACKEND"] = "vercel"
+
+    import server
+    server.ROUTES = server.load_routes()
+    httpd = server.PooledHTTPServer(("127.0.0.1", 0), server.H, workers=max(args.concurrency, 4))
+    base = f"http://127.0.0.1:{httpd.server_address[1]}"
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    # The cron needs a schedule; menus/publish need nothing else
+    call(base, "POST", "/api/schedule", {"pin": ADMIN_PIN, "schedule": {"enabled": True, "rules": ALL_DAY}})
+
+    wanted = [s for s in args.only.split(",") if s]
+    specs = scenarios()
+    unknown = [s for s in wanted if s not in specs]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    print(f"upstream latency {args.latency:g}±{args.jitter:g} ms, error rate {args.error_rate:g}, "
+          f"storage {args.storage}{', cold' if args.cold else ''}\n")
+    print(f"{'scenario':<15}{'n':>6}{'c':>4}{'err':>5}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}  upstream calls/request")
+    results = []
+    for name, spec in specs.items():
+        if wanted and name not in wanted:
+            continue
+        results.append(run_scenario(base, upstreams, name, spec, args.requests, args.concurrency, args.cold))
+        print_row(results[-1])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+    httpd.shutdown()
+    httpd.server_close()
+    upstreams.stop()
+
+
+if __name__ == "__main__":
+    main()
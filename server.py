@@ -1,50 +1,207 @@
 #!/usr/bin/env python3
 from http.server import HTTPServer, SimpleHTTPRequestHandler
-import urllib.request, json, ssl, os
+from concurrent.futures import ThreadPoolExecutor
+import urllib.parse, importlib, json, os, re, signal, sys, threading, time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+import _net, _singleflight
 
 PORT = 8080
-TOKEN_API = "https://dotyk.me/api/v1.2/token/password/"
-LOGIN_API = "https://dotyk.tech/api/user/LoginWithDotykMe"
+WORKERS = int(os.environ.get('WORKERS', '8'))  # peticiones atendidas a la vez
 AUTH_TOKEN = None
-
-def ssl_ctx():
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    return ctx
+ROUTES = []  # [(regex, handler class)] from vercel.json, filled in at startup
+LOCAL_METHODS = ('PATCH',)  # nunca pasan a los handlers de api/: proxy local como siempre
+SCHEDULER = None
+JOB_WORKER = None
+RECHECK = 60  # s: máximo entre ticks del programador (recoge cambios del horario)
 
 def load_config():
     p = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
     return json.load(open(p)) if os.path.exists(p) else {}
 
-def get_token(email, pwd):
-    print("🔐 [1/2] Obteniendo token...")
-    body = json.dumps({"username": email, "password": pwd, "duration": "Long", "audience": "https://dotyk.tech/", "scope": ["basic"]}).encode()
-    req = urllib.request.Request(TOKEN_API, data=body, headers={'Content-Type': 'application/json'}, method='POST')
-    try:
-        with urllib.request.urlopen(req, context=ssl_ctx(), timeout=30) as r:
-            data = json.loads(r.read().decode())
-            token = data.get('token') or data.get('access_token')
-            print(f"   ✅ Token OK: {str(token)[:40]}...")
-            return token
-    except Exception as e:
-        print(f"   ❌ Error: {e}")
-        return None
-
-def login(token):
-    print("🔑 [2/2] Login dotyk.tech...")
-    body = f'"{token}"'.encode()
-    req = urllib.request.Request(LOGIN_API, data=body, headers={'Content-Type': 'application/json; charset=utf-8'}, method='POST')
+def apply_config(cfg):
+    """config.json -> variables de entorno que leen los handlers de api/ al importarse."""
+    for key, env in (('email', 'DOTYK_EMAIL'), ('password', 'DOTYK_PASSWORD'),
+                     ('blob_token', 'BLOB_READ_WRITE_TOKEN'), ('cron_secret', 'CRON_SECRET'),
+                     ('storage_backend', 'STORAGE_BACKEND'), ('storage_dir', 'STORAGE_DIR')):
+        if cfg.get(key):
+            os.environ.setdefault(env, cfg[key])
+    # Sin token de Blob: horario y logs en disco (.storage/)
+    if not os.environ.get('BLOB_READ_WRITE_TOKEN'):
+        os.environ.setdefault('STORAGE_BACKEND', 'local')
+
+def load_routes():
+    """Rutas /api/* de vercel.json -> clase handler del módulo de api/, importado en este proceso.
+
+    Todos los handlers comparten así tokens, sesión, pool de conexiones y cachés.
+    """
+    with open(os.path.join(ROOT, 'vercel.json')) as f:
+        cfg = json.load(f)
+    routes = []
+    for route in cfg.get('routes', []):
+        dest = route.get('dest', '')
+        if not dest.startswith('/api/') or not dest.endswith('.py'):
+            continue
+        module = importlib.import_module(os.path.splitext(os.path.basename(dest))[0])
+        # Misma clase, sin el log por petición de BaseHTTPRequestHandler (igual que H)
+        cls = type(module.handler.__name__, (module.handler,), {'log_message': lambda self, *a: None, '__module__': module.__name__})
+        routes.append((re.compile(route['src'] + '$'), cls))
+    return routes
+
+class Scheduler(threading.Thread):
+    """Cron dentro del proceso: ejecuta api/cron.reconcile() justo al llegar
+    cada cambio de horario en vez de esperar a que alguien llame a /api/cron.
+
+    Duerme hasta la próxima transición (como mucho RECHECK s) y guarda el
+    estado para GET /api/scheduler.
+    """
+
+    def __init__(self, cron):
+        super().__init__(name='scheduler', daemon=True)
+        self.cron = cron
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.state = {'running': False, 'runs': 0, 'nextRun': None, 'lastRun': None,
+                      'lastCode': None, 'lastResult': None, 'driftMs': None}
+
+    def status(self):
+        with self.lock:
+            return dict(self.state)
+
+    def kick(self):
+        """Tick inmediato (POST /api/scheduler)."""
+        self.wake.set()
+
+    def tick(self, planned):
+        started = time.time()
+        try:
+            code, result = self.cron.reconcile()
+        except Exception as e:
+            code, result = 500, {'error': f'Cron: {e}'}
+        nxt = result.get('nextTransition')
+        with self.lock:
+            self.state.update(
+                runs=self.state['runs'] + 1,
+                lastRun=started,
+                lastCode=code,
+                lastResult=result,
+                # Retraso respecto a la transición para la que nos despertamos
+                driftMs=round((started - planned) * 1000) if planned else self.state['driftMs'],
+            )
+        if code == 200 and result.get('action') == 'updated':
+            print(f"⏰ Horario aplicado: {', '.join(result.get('enabled_menus') or []) or 'ninguno'}")
+        elif code != 200:
+            print(f"⏰ Error del programador: {result.get('error')}")
+        return nxt
+
+    def run(self):
+        with self.lock:
+            self.state['running'] = True
+        planned = None
+        while True:
+            nxt = self.tick(planned)
+            now = time.time()
+            if nxt and nxt - now <= RECHECK:
+                planned, wait = nxt, max(nxt - now, 0)
+            else:
+                planned, wait = None, RECHECK
+            with self.lock:
+                self.state['nextRun'] = now + wait
+            if self.wake.wait(wait):
+                self.wake.clear()
+                planned = None
+
+class JobWorker(threading.Thread):
+    """Ejecuta la cola de publicaciones (api/_jobs.py) en cuanto se encola
+    algo, y los reintentos a su hora, sin esperar a /api/publish/run ni al cron."""
+
+    def __init__(self, publish):
+        super().__init__(name='jobs', daemon=True)
+        self.publish = publish
+        self.wake = threading.Event()
+
+    def kick(self, job=None):
+        self.wake.set()
+
+    def run(self):
+        import _jobs
+        while True:
+            try:
+                for job in self.publish.run_jobs():
+                    print(f"📺 Publicación {job['id']}: {job['status']} (intento {job['attempts']})"
+                          + (f" - {job['error']}" if job.get('error') else ''))
+                nxt = _jobs.next_due()
+            except Exception as e:
+                print(f"📺 Error de la cola de publicación: {e}")
+                nxt = None
+            wait = RECHECK if nxt is None else min(max(nxt - time.time(), 0.5), RECHECK)
+            if self.wake.wait(wait):
+                self.wake.clear()
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer que atiende cada petición en un pool acotado de hilos,
+    así un proxy lento no bloquea index.html ni el resto de llamadas."""
+
+    def __init__(self, addr, handler, workers=WORKERS):
+        super().__init__(addr, handler)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._work, request, client_address)
+
+    def _work(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=True)  # deja terminar las peticiones en curso
+
+def serve(handler, port=PORT):
+    """Arranca el servidor y lo para limpiamente con Ctrl+C / SIGTERM."""
+    httpd = PooledHTTPServer(('', port), handler)
+
+    def stop(signum, frame):
+        print("\n🛑 Parando servidor (esperando peticiones en curso)...")
+        # shutdown() bloquea hasta que serve_forever sale: no se puede llamar desde su hilo
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
     try:
-        with urllib.request.urlopen(req, context=ssl_ctx(), timeout=30) as r:
-            print("   ✅ Login OK")
-            return r.headers.get('Set-Cookie', '')
-    except Exception as e:
-        print(f"   ❌ Error: {e}")
-        return None
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
 
 class H(SimpleHTTPRequestHandler):
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        # /api/* de vercel.json: el resto de la petición la atiende el handler de ese módulo.
+        # PATCH /api/* sigue en H (proxy_patch a la Template API), aunque el módulo
+        # tenga do_PATCH (publish.py, que es el destino de /api/template en Vercel).
+        if self.command in LOCAL_METHODS:
+            return True
+        path = urllib.parse.urlparse(self.path).path
+        for pattern, cls in ROUTES:
+            if pattern.match(path):
+                if hasattr(cls, 'do_' + self.command):
+                    self.__class__ = cls
+                break
+        return True
     def do_GET(self):
+        if urllib.parse.urlparse(self.path).path == '/api/scheduler':
+            self.send_response(200 if SCHEDULER else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps(SCHEDULER.status() if SCHEDULER else {'error': 'Programador desactivado'}).encode())
+            return
         if 'favicon' in self.path:
             self.send_response(204)
             self.end_headers()
@@ -56,6 +213,16 @@ class H(SimpleHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Methods', '*')
         self.send_header('Access-Control-Allow-Headers', '*')
         self.end_headers()
+    def do_POST(self):
+        if urllib.parse.urlparse(self.path).path == '/api/scheduler' and SCHEDULER:
+            SCHEDULER.kick()
+            self.send_response(202)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps(SCHEDULER.status()).encode())
+            return
+        self.send_error(404)
     def do_PATCH(self):
         if '/api/' in self.path:
             self.proxy_patch()
@@ -71,18 +238,21 @@ class H(SimpleHTTPRequestHandler):
             headers = {'Content-Type': 'application/json', 'Accept': '*/*'}
             if AUTH_TOKEN:
                 headers['Authorization'] = f'Bearer {AUTH_TOKEN}'
-            req = urllib.request.Request(API, data=body, headers=headers, method='PATCH')
-            with urllib.request.urlopen(req, context=ssl_ctx(), timeout=30) as r:
-                out = r.read()
-                print(f"   ✅ OK: {r.status}")
-                self.send_response(r.status)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(out or b'{}')
-        except urllib.error.HTTPError as e:
-            err = e.read() if hasattr(e, 'read') else b'{}'
-            print(f"   ❌ HTTP {e.code}: {err.decode()[:100]}")
+            def send():
+                # Conexión keep-alive reutilizada (pool compartido de api/_net.py)
+                r = _net.request('PATCH', API, body=body, headers=headers, timeout=30)
+                return r.status, r.body
+            # El mismo PATCH repetido a la vez (doble clic) sale una sola vez
+            status, resp_body = _singleflight.do('template', API, (body or b'').decode(errors='replace'), send)
+            print(f"   ✅ OK: {status}")
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(resp_body or b'{}')
+        except _net.HTTPError as e:
+            err = e.body or b'{}'
+            print(f"   ❌ HTTP {e.code}: {err.decode(errors='replace')[:100]}")
             self.send_response(e.code)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
@@ -99,12 +269,31 @@ if __name__ == '__main__':
     print("=" * 50)
     print("🎬 DOTYK PUBLISHER v4")
     print("=" * 50)
-    cfg = load_config()
-    if cfg.get('email') and cfg.get('password'):
-        AUTH_TOKEN = get_token(cfg['email'], cfg['password'])
-        if AUTH_TOKEN:
-            login(AUTH_TOKEN)
+    apply_config(load_config())
+    ROUTES = load_routes()
+    print(f"🧭 {len(ROUTES)} rutas /api/* de vercel.json en este proceso")
+    import _blob
+    print(f"💾 Almacenamiento: {_blob.STORAGE_DIR if _blob.BACKEND == 'local' else 'Vercel Blob'}")
+    import _dotyk
+    if _dotyk.EMAIL and _dotyk.PASSWORD:
+        # Token y sesión quedan en las cachés compartidas con los handlers de api/
+        print("🔐 Token + login dotyk.tech...")
+        try:
+            AUTH_TOKEN = _dotyk.get_tech_token()
+            _dotyk.get_tech_session()
+            print(f"   ✅ OK: {str(AUTH_TOKEN)[:40]}...")
+        except Exception as e:
+            print(f"   ❌ Error: {e}")
     if not AUTH_TOKEN:
         print("\n⚠️  Sin token - puede haber errores 403")
-    print(f"\n✅ http://localhost:{PORT}\n")
-    HTTPServer(('', PORT), H).serve_forever()
+    if os.environ.get('SCHEDULER', '1') != '0':
+        import cron
+        SCHEDULER = Scheduler(cron)
+        SCHEDULER.start()
+        print("⏰ Programador activo (estado en /api/scheduler)")
+        import _jobs, publish
+        JOB_WORKER = JobWorker(publish)
+        _jobs.on_enqueue = JOB_WORKER.kick
+        JOB_WORKER.start()
+    print(f"\n✅ http://localhost:{PORT}  ({WORKERS} hilos)\n")
+    serve(H)
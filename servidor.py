@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import SimpleHTTPRequestHandler
 import urllib.request, urllib.parse, json, ssl, os
 
+from server import serve, _net
+
 PORT = 8080
 API = "https://eu.performanceshow.dotyk.cloud/nua-barcelona/Template"
 TOKEN = None
@@ -68,21 +70,16 @@ class H(SimpleHTTPRequestHandler):
             hdrs = {'Content-Type': 'application/json', 'Accept': '*/*'}
             if TOKEN:
                 hdrs['Authorization'] = f'Bearer {TOKEN}'
-            req = urllib.request.Request(API, data=body, headers=hdrs, method='PATCH')
-            ctx = ssl.create_default_context()
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
-            with urllib.request.urlopen(req, context=ctx, timeout=30) as r:
-                out = r.read()
-                print(f"✅ {r.status}")
-                self.send_response(r.status)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(out or b'{}')
-        except urllib.error.HTTPError as e:
-            err = e.read() if hasattr(e, 'read') else b'{}'
-            print(f"❌ {e.code}: {err.decode()[:200]}")
+            r = _net.request('PATCH', API, body=body, headers=hdrs, timeout=30)
+            print(f"✅ {r.status}")
+            self.send_response(r.status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(r.body or b'{}')
+        except _net.HTTPError as e:
+            err = e.body or b'{}'
+            print(f"❌ {e.code}: {err.decode(errors='replace')[:200]}")
             self.send_response(e.code)
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
@@ -100,4 +97,4 @@ if __name__ == '__main__':
     print("="*50)
     auth()
     print(f"\n✅ http://localhost:{PORT}\n")
-    HTTPServer(('', PORT), H).serve_forever()
+    serve(H, PORT)